@@ -0,0 +1,535 @@
+#! /usr/bin/python3
+"""
+Query the ISTEX API from an asyncio event loop
+
+Same functions and same URLs as api.py (cf. api.count_url etc.) but the
+requests of many coroutines are multiplexed on one event loop, with a
+semaphore to limit the number of requests in flight:
+
+    async def main():
+        async with AsyncSession(max_concurrency=50) as s:
+            totals = await gather(*[count(q, session=s) for q in queries])
+            async for hit in search("corpusName:nature", outfields=['id'],
+                                    session=s):
+                print(hit['id'])
+
+NB: no RESPONSE_CACHE here (unlike api._get)
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2014-5 INIST-CNRS (ISTEX project)"
+__license__   = "LGPL"
+__version__   = "0.1"
+__email__     = "romain.loth@inist.fr"
+__status__    = "Dev"
+
+import asyncio
+from ssl             import create_default_context
+from json            import loads
+from urllib.parse    import urlsplit, urljoin
+from urllib.request  import getproxies, proxy_bypass
+from http.client     import HTTPMessage
+from urllib.error    import URLError, HTTPError
+from base64          import b64encode
+from io              import BytesIO
+from hashlib         import sha1
+from os              import path, replace, remove
+from tempfile        import NamedTemporaryFile
+from sys             import stderr
+
+# imports locaux
+try:
+	# CHEMIN 1 cas de figure du dossier utilisé comme librairie
+	#          au sein d'un package plus grand (exemple: bib-adapt-corpus)
+	from libconsulte import api
+except ImportError:
+	try:
+		# CHEMIN 2: cas de figure d'un appel depuis le dossier courant
+		import api
+	except ImportError:
+		print("ERR: Le module 'api.py' doit être placé à côté de aioapi.py ou dans un dossier du PYTHONPATH", file=stderr)
+		exit(1)
+
+# globals
+# same defaults and exceptions as the sync module
+DEFAULT_API_CONF = api.DEFAULT_API_CONF
+PAGE_SIZE = api.PAGE_SIZE
+SCROLL_TTL = api.SCROLL_TTL
+CHUNK_SIZE = api.CHUNK_SIZE
+AuthWarning = api.AuthWarning
+
+# max requests in flight per session (cf. AsyncSession)
+DEFAULT_CONCURRENCY = 20
+# keep-alive connections kept per host
+DEFAULT_POOL_SIZE = api.DEFAULT_POOL_SIZE
+# timeout in seconds for each network operation
+DEFAULT_TIMEOUT = api.DEFAULT_TIMEOUT
+
+USER_AGENT = 'consulte-aioapi/%s' % __version__
+
+
+class AsyncSession(object):
+	"""
+	Minimal keep-alive http(s) 1.1 client on top of asyncio streams
+	
+	At most *max_concurrency* requests are in flight at the same time
+	(from the request to the end of the response body) and up to
+	*pool_size* idle connections per (scheme, host) are kept for reuse.
+	
+	Errors are raised like in api.HTTPSession: HTTPError for http
+	status >= 400 and URLError for network problems.
+	
+	A session is bound to the event loop where it was first used (if
+	the loop changes, the idle connections are forgotten).
+	
+	Like api.HTTPSession, the http_proxy/https_proxy/no_proxy environment
+	variables are honoured (or *proxies* {scheme: proxy_url} if given):
+	https goes through a CONNECT tunnel, http sends absolute urls.
+	"""
+	def __init__(self, max_concurrency=DEFAULT_CONCURRENCY,
+	             pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+	             proxies=None):
+		self.max_concurrency = max_concurrency
+		self.pool_size = pool_size
+		self.timeout = timeout
+		self.proxies = getproxies() if proxies is None else proxies
+		self._ssl = create_default_context()
+		self._loop = None
+		self._sem = None
+		# (scheme, host) => list of idle (reader, writer)
+		self._pools = {}
+	
+	def _check_loop(self):
+		loop = asyncio.get_running_loop()
+		if loop is not self._loop:
+			self._loop = loop
+			self._sem = asyncio.Semaphore(self.max_concurrency)
+			self._pools = {}
+	
+	async def _wait(self, aw):
+		"""Awaits a network operation with the session timeout"""
+		return await asyncio.wait_for(aw, self.timeout)
+	
+	def _proxy(self, scheme, host):
+		"""
+		Splitted proxy url for this scheme and host (or None)
+		"""
+		proxy = self.proxies.get(scheme)
+		if not proxy or proxy_bypass(urlsplit('//' + host).hostname):
+			return None
+		if '://' not in proxy:
+			proxy = 'http://' + proxy
+		return urlsplit(proxy)
+	
+	async def _connect(self, scheme, host):
+		splitted = urlsplit('//' + host)
+		proxy = self._proxy(scheme, host)
+		if proxy is None:
+			if scheme == 'https':
+				return await self._wait(asyncio.open_connection(
+					splitted.hostname, splitted.port or 443,
+					ssl=self._ssl, server_hostname=splitted.hostname))
+			else:
+				return await self._wait(asyncio.open_connection(
+					splitted.hostname, splitted.port or 80))
+		
+		conn = await self._wait(asyncio.open_connection(
+			proxy.hostname, proxy.port or 80))
+		if scheme != 'https':
+			return conn
+		
+		# TLS with the real host inside a CONNECT tunnel
+		reader, writer = conn
+		if not hasattr(writer, 'start_tls'):
+			writer.close()
+			raise OSError('https through a proxy needs python >= 3.11')
+		target = '%s:%i' % (splitted.hostname, splitted.port or 443)
+		lines = ['CONNECT %s HTTP/1.1' % target, 'Host: %s' % target]
+		for k, v in api.HTTPSession._proxy_auth(proxy).items():
+			lines.append('%s: %s' % (k, v))
+		writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+		await self._wait(writer.drain())
+		status, reason, _ = await self._read_head(reader)
+		if status != 200:
+			writer.close()
+			raise OSError('proxy CONNECT %s: %i %s' % (target, status, reason))
+		await self._wait(writer.start_tls(self._ssl,
+		                                  server_hostname=splitted.hostname))
+		return (reader, writer)
+	
+	def _release(self, scheme, host, conn):
+		pool = self._pools.setdefault((scheme, host), [])
+		if len(pool) < self.pool_size:
+			pool.append(conn)
+		else:
+			# already enough idle connections for this host
+			conn[1].close()
+	
+	async def _request(self, conn, host, selector, headers):
+		"""
+		Sends the GET request, reads the status line and the headers
+		"""
+		reader, writer = conn
+		lines = ['GET %s HTTP/1.1' % selector,
+		         'Host: %s' % host,
+		         'User-Agent: %s' % USER_AGENT,
+		         'Accept-Encoding: identity',
+		         'Connection: keep-alive']
+		for k, v in headers.items():
+			lines.append('%s: %s' % (k, v))
+		writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+		await self._wait(writer.drain())
+		
+		return await self._read_head(reader)
+	
+	async def _read_head(self, reader):
+		"""
+		Reads the status line and the headers of a response
+		(case-insensitive headers, like http.client's resp.msg)
+		"""
+		status_line = await self._wait(reader.readline())
+		if not status_line:
+			raise ConnectionResetError('connection closed by the server')
+		version, status, reason = (status_line.decode('latin-1')
+		                                      .rstrip('\r\n')
+		                                      .split(' ', 2) + [''])[0:3]
+		
+		resp_headers = HTTPMessage()
+		while True:
+			line = await self._wait(reader.readline())
+			if line in (b'\r\n', b'\n', b''):
+				break
+			k, _, v = line.decode('latin-1').partition(':')
+			resp_headers[k.strip()] = v.strip()
+		
+		return (int(status), reason, resp_headers)
+	
+	async def _send(self, scheme, host, selector, headers):
+		"""
+		GET request on a pooled connection => (conn, status, reason, headers)
+		"""
+		pool = self._pools.get((scheme, host))
+		if pool:
+			conn = pool.pop()
+			try:
+				return (conn,) + await self._request(conn, host,
+				                                     selector, headers)
+			except (OSError, ValueError, asyncio.TimeoutError):
+				# idle connection probably closed by the server: 1 retry
+				conn[1].close()
+		
+		try:
+			conn = await self._connect(scheme, host)
+			return (conn,) + await self._request(conn, host,
+			                                     selector, headers)
+		except (OSError, ValueError, asyncio.TimeoutError) as conn_e:
+			raise URLError(conn_e)
+	
+	async def open(self, my_url, headers=None, max_redirects=5):
+		"""
+		GET my_url and return an AsyncResponse
+		
+		The response must be closed (or used with 'async with') to
+		free its place in the concurrency limit.
+		"""
+		self._check_loop()
+		if headers is None:
+			headers = {}
+		
+		await self._sem.acquire()
+		try:
+			for n_redirects in range(max_redirects + 1):
+				splitted = urlsplit(my_url)
+				scheme = splitted.scheme
+				host = splitted.netloc
+				selector = splitted.path or '/'
+				if splitted.query:
+					selector += '?' + splitted.query
+				
+				req_headers = headers
+				if scheme == 'http':
+					# plain http through a proxy: absolute url in the request
+					proxy = self._proxy(scheme, host)
+					if proxy is not None:
+						selector = 'http://' + host + selector
+						req_headers = dict(headers,
+						                   **api.HTTPSession._proxy_auth(proxy))
+				
+				conn, status, reason, resp_headers = await self._send(
+				                        scheme, host, selector, req_headers)
+				
+				resp = AsyncResponse(self, conn, scheme, host, my_url,
+				                     status, reason, resp_headers)
+				
+				# redirections
+				if status in (301, 302, 303, 307, 308):
+					location = resp_headers.get('location')
+					await resp.read()
+					await resp.close(release_slot=False)
+					if location is None:
+						raise HTTPError(my_url, status, 'no Location',
+						                resp_headers, None)
+					new_url = urljoin(my_url, location)
+					# pas de mot de passe envoyé à un autre hôte
+					if urlsplit(new_url).netloc != host:
+						headers = {k:v for k,v in headers.items()
+						             if k.lower() != 'authorization'}
+					my_url = new_url
+					continue
+				
+				# erreurs http => même exception que urlopen
+				if status >= 400:
+					body = await resp.read()
+					await resp.close(release_slot=False)
+					raise HTTPError(my_url, status, reason,
+					                resp_headers, BytesIO(body))
+				
+				return resp
+			
+			raise URLError("too many redirections for '%s'" % my_url)
+		
+		except BaseException:
+			self._sem.release()
+			raise
+	
+	async def get_json(self, my_url):
+		"""GET my_url and parse the json response"""
+		async with await self.open(my_url) as resp:
+			return loads((await resp.read()).decode('UTF-8'))
+	
+	async def close(self):
+		"""Closes all idle connections"""
+		for pool in self._pools.values():
+			for reader, writer in pool:
+				writer.close()
+		self._pools = {}
+	
+	async def __aenter__(self):
+		return self
+	
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+
+class AsyncResponse(object):
+	"""
+	Body of an http response (Content-Length, chunked or until close)
+	
+	When closed after a complete read its connection returns to the
+	session pool (otherwise it is dropped).
+	"""
+	def __init__(self, session, conn, scheme, host, url,
+	             status, reason, headers):
+		self._session = session
+		self._conn = conn
+		self._scheme = scheme
+		self._host = host
+		self._closed = False
+		self.url = url
+		self.status = status
+		self.reason = reason
+		self.headers = headers
+		
+		self._chunked = 'chunked' in headers.get('transfer-encoding', '')
+		self._chunk_left = 0
+		if self._chunked:
+			self._length = None
+		elif 'content-length' in headers:
+			self._length = int(headers['content-length'])
+		else:
+			self._length = None
+		self._complete = (self._length == 0)
+		self._will_close = (headers.get('connection', '').lower() == 'close'
+		                    or (not self._chunked and self._length is None))
+	
+	async def _read_chunk(self, amt):
+		reader = self._conn[0]
+		wait = self._session._wait
+		if self._chunked:
+			if self._chunk_left == 0:
+				size_line = await wait(reader.readline())
+				chunk_size = int(size_line.split(b';')[0], 16)
+				if chunk_size == 0:
+					# trailers
+					while (await wait(reader.readline())) not in (b'\r\n', b'\n', b''):
+						pass
+					self._complete = True
+					return b''
+				self._chunk_left = chunk_size
+			data = await wait(reader.read(min(amt, self._chunk_left)))
+			if not data:
+				raise ConnectionResetError('incomplete chunked body')
+			self._chunk_left -= len(data)
+			if self._chunk_left == 0:
+				await wait(reader.readexactly(2))
+			return data
+		
+		elif self._length is not None:
+			data = await wait(reader.read(min(amt, self._length)))
+			if not data:
+				raise ConnectionResetError('incomplete body')
+			self._length -= len(data)
+			if self._length == 0:
+				self._complete = True
+			return data
+		
+		else:
+			data = await wait(reader.read(amt))
+			if not data:
+				self._complete = True
+			return data
+	
+	async def read(self, amt=None):
+		"""
+		Reads *amt* bytes at most (b'' at the end) or the whole body
+		"""
+		try:
+			if amt is not None:
+				if self._complete:
+					return b''
+				return await self._read_chunk(amt)
+			
+			chunks = []
+			while not self._complete:
+				chunks.append(await self._read_chunk(CHUNK_SIZE))
+			return b''.join(chunks)
+		
+		except (OSError, ValueError, asyncio.IncompleteReadError,
+		        asyncio.TimeoutError) as read_e:
+			self._will_close = True
+			raise URLError(read_e)
+	
+	async def close(self, release_slot=True):
+		if self._closed:
+			return
+		self._closed = True
+		if self._complete and not self._will_close:
+			self._session._release(self._scheme, self._host, self._conn)
+		else:
+			self._conn[1].close()
+		if release_slot:
+			self._session._sem.release()
+	
+	async def __aenter__(self):
+		return self
+	
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+
+# module-level session used when no session is passed
+SESSION = AsyncSession()
+
+def _session(session):
+	return session if session is not None else SESSION
+
+
+# public functions
+# ----------------
+async def count(q, api_conf=DEFAULT_API_CONF, already_escaped=False, session=None):
+	"""
+	Get total hits for a lucene query on ISTEX api (cf. api.count)
+	"""
+	json_values = await _session(session).get_json(
+	                        api.count_url(q, api_conf, already_escaped))
+	return int(json_values['total'])
+
+
+async def search(q, api_conf=DEFAULT_API_CONF, limit=None, outfields=('title','host.issn','fulltext'), page_size=PAGE_SIZE, scroll=SCROLL_TTL, random_seed=None, session=None):
+	"""
+	Async iterator over the hits of a query (cf. api.iter_search)
+	
+	   async for hit in search("corpusName:nature", outfields=['id']):
+	       print(hit['id'])
+	"""
+	session = _session(session)
+	
+	if limit is not None and limit < page_size:
+		page_size = limit
+	
+	# URL de la première page, puis curseur scroll
+	my_url = api.search_url(q, api_conf, outfields, size=page_size,
+	                        scroll=scroll, random_seed=random_seed)
+	
+	n_yielded = 0
+	while my_url:
+		json_values = await session.get_json(my_url)
+		hits = json_values.get('hits', [])
+		
+		for hit in hits:
+			if limit is not None and n_yielded >= limit:
+				return
+			yield hit
+			n_yielded += 1
+		
+		if not hits or json_values.get('noMoreScrollResults'):
+			break
+		
+		my_url = json_values.get('nextScrollURI')
+
+
+async def terms_facet(facet_name, q="*", api_conf=DEFAULT_API_CONF, with_other=False, session=None):
+	"""
+	Values of a field with their counts (cf. api.terms_facet)
+	"""
+	json_values = await _session(session).get_json(
+	                        api.facet_url(facet_name, q, api_conf))
+	return api.facet_counts(json_values, facet_name, with_other)
+
+
+async def fetch_fulltext(DID, api_type='fulltext/pdf', tgt_path=None, api_conf=DEFAULT_API_CONF, user=None, passw=None, session=None):
+	"""
+	Get a document's fulltext or metadata file (cf. api.write_fulltexts)
+	
+	Without *tgt_path* returns the bytes, otherwise copies the file by
+	chunks to a temporary file renamed to tgt_path when complete and
+	returns (n_bytes, hex sha1).
+	
+	Returns None for a 404 etc.
+	Raises AuthWarning if the API wants an authentification
+	and HTTPError for the transient errors (429, 5xx: cf. api.is_transient)
+	"""
+	headers = {}
+	if user is not None:
+		credentials = b64encode(('%s:%s' % (user, passw)).encode('UTF-8'))
+		headers['Authorization'] = 'Basic ' + credentials.decode('ascii')
+	
+	my_url = api.fulltext_url(DID, api_type, api_conf)
+	
+	try:
+		resp = await _session(session).open(my_url, headers=headers)
+	except HTTPError as url_e:
+		if url_e.getcode() == 401:
+			raise AuthWarning("need_auth")
+		elif api.is_transient(url_e):
+			# erreur serveur ou 429 (transitoire) => à l'appelant de réessayer
+			raise
+		else:
+			print("aioapi: HTTP ERR no %i (%s) sur '%s'" %
+				(url_e.getcode(), url_e.msg, my_url), file=stderr)
+			return None
+	
+	async with resp:
+		if tgt_path is None:
+			return await resp.read()
+		
+		hasher = sha1()
+		n_bytes = 0
+		tmp_fh = NamedTemporaryFile(dir=path.dirname(path.abspath(tgt_path)),
+		                            prefix='.part-', delete=False)
+		try:
+			try:
+				while True:
+					chunk = await resp.read(CHUNK_SIZE)
+					if not chunk:
+						break
+					tmp_fh.write(chunk)
+					n_bytes += len(chunk)
+					hasher.update(chunk)
+			finally:
+				tmp_fh.close()
+			replace(tmp_fh.name, tgt_path)
+		except BaseException:
+			remove(tmp_fh.name)
+			raise
+	
+	return (n_bytes, hasher.hexdigest())
@@ -10,11 +10,24 @@ __email__     = "romain.loth@inist.fr"
 __status__    = "Dev"
 
 from json            import loads
-from urllib.parse    import quote
-from urllib.request  import urlopen, HTTPBasicAuthHandler, build_opener, install_opener
-from urllib.error    import URLError
+from urllib.parse    import quote, urlsplit, urljoin, unquote
+from urllib.request  import getproxies, proxy_bypass
+from urllib.error    import URLError, HTTPError
+from http.client     import HTTPConnection, HTTPSConnection, HTTPException, IncompleteRead
+from queue           import LifoQueue, Empty, Full
+from threading       import Lock
+from time            import monotonic, sleep, time
+from base64          import b64encode
+from random          import uniform
+from email.utils     import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io              import BytesIO
+from hashlib         import sha1
 from getpass   import getpass
-from os import path
+from os import path, replace, remove, close, makedirs, environ
+from tempfile import NamedTemporaryFile, mkstemp
+from zlib import compress, decompress
+import sqlite3
 from sys import stderr
 from re import sub
 from json import dumps  # pretty printing si debug ou main
@@ -25,82 +38,786 @@ DEFAULT_API_CONF = {
 	'route' : 'document'
 }
 
+# keep-alive connections kept per host (cf. HTTPSession)
+DEFAULT_POOL_SIZE = 10
+# socket timeout in seconds
+DEFAULT_TIMEOUT = 60
+# max requests per second and per host (None: no limit)
+DEFAULT_MAX_RATE = None
+# retries of _get on transient errors (network, 429, 5xx) with
+# exponential backoff (seconds) unless the server sends a Retry-After
+RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+TRANSIENT_CODES = (429, 500, 502, 503, 504)
+# adaptive rate (cf. TokenBucket): start rate per host when the server
+# throttles us without a max_rate, and minimum rate after slow downs
+THROTTLE_START_RATE = 10
+THROTTLE_MIN_RATE = 0.5
+# parallel fulltext downloads and attempts per doc
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 3
+# read size when copying fulltexts to disk
+CHUNK_SIZE = 1 << 16
+# hits per search request and lifetime of a scroll cursor between pages
+PAGE_SIZE = 5000
+SCROLL_TTL = '1m'
+# number of hits above which search() stores them on disk (cf. HitStore)
+SPILL_THRESHOLD = 200000
+# json responses cache (cf. ResponseCache)
+# (in the user cache dir, not in the package: may be read-only)
+CACHE_PATH = path.join(environ.get('XDG_CACHE_HOME')
+                       or path.join(path.expanduser('~'), '.cache'),
+                       'consulte', 'responses.sqlite')
+CACHE_TTL = 24 * 3600
+CACHE_MAX_ENTRIES = 100000
+
 class AuthWarning(Exception):
 	def __init__(self, msg):
 		self.msg = msg
 	def __str__(self):
 		return repr(self.msg)
 
+# connection pooling
+# ------------------
+class TokenBucket(object):
+	"""
+	Thread-safe rate limiter: *rate* requests per second on average
+	with bursts of at most *burst* requests
+	
+	The rate is adaptive (AIMD): slow_down() halves it (when the server
+	answers 429/503) and speed_up() raises it back by small steps after
+	each success, up to *max_rate* (None: no ceiling).
+	"""
+	def __init__(self, rate, burst=None, max_rate=None,
+	             min_rate=THROTTLE_MIN_RATE):
+		self.rate = float(rate)
+		self.burst = burst
+		self.max_rate = max_rate
+		self.min_rate = min(min_rate, self.rate)
+		self.capacity = burst if burst else max(1.0, self.rate)
+		self.tokens = self.capacity
+		self.stamp = monotonic()
+		self.paused_until = 0
+		self._lock = Lock()
+	
+	def take(self):
+		"""
+		Blocks until a request is allowed
+		"""
+		with self._lock:
+			now = monotonic()
+			self.tokens = min(self.capacity,
+			                  self.tokens + (now - self.stamp) * self.rate)
+			self.stamp = now
+			# the token is reserved even if we have to wait for it
+			self.tokens -= 1
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+			wait = max(wait, self.paused_until - now)
+		if wait > 0:
+			sleep(wait)
+	
+	def _set_rate(self, rate):
+		self.rate = rate
+		self.capacity = self.burst if self.burst else max(1.0, rate)
+		self.tokens = min(self.tokens, self.capacity)
+	
+	def slow_down(self, pause=None):
+		"""
+		Multiplicative decrease, and no request at all during *pause*
+		seconds if given (ex: the server's Retry-After)
+		"""
+		with self._lock:
+			self._set_rate(max(self.min_rate, self.rate / 2))
+			if pause:
+				self.paused_until = max(self.paused_until, monotonic() + pause)
+	
+	def speed_up(self):
+		"""
+		Additive increase: about +1 request/s per second of successes
+		"""
+		with self._lock:
+			new_rate = self.rate + 1.0 / self.rate
+			if self.max_rate is not None:
+				new_rate = min(new_rate, self.max_rate)
+			self._set_rate(new_rate)
+
+
+class HTTPSession(object):
+	"""
+	Minimal keep-alive http(s) client on top of http.client
+	
+	Keeps up to *pool_size* idle connections per (scheme, host) so that
+	successive api calls reuse the same TCP+TLS connection instead of
+	paying a new handshake each time (thread-safe).
+	
+	If *max_rate* is given, requests to each host are throttled to that
+	many per second (cf. TokenBucket). In any case a host answering 429
+	or 503 gets an adaptive rate limit (slower after each of these
+	answers, faster again after successes).
+	
+	Errors are raised like urlopen would: HTTPError for http status >= 400
+	and URLError for network problems.
+	
+	Like urlopen, the http_proxy/https_proxy/no_proxy environment
+	variables are honoured (or *proxies* {scheme: proxy_url} if given):
+	https goes through a CONNECT tunnel, http sends absolute urls.
+	"""
+	def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+	             max_rate=DEFAULT_MAX_RATE, proxies=None):
+		self.pool_size = pool_size
+		self.timeout = timeout
+		self.max_rate = max_rate
+		self.proxies = getproxies() if proxies is None else proxies
+		# (scheme, host) => LifoQueue of idle connections
+		self._pools = {}
+		# host => TokenBucket
+		self._buckets = {}
+		self._lock = Lock()
+	
+	def _pool(self, scheme, host):
+		with self._lock:
+			if (scheme, host) not in self._pools:
+				self._pools[(scheme, host)] = LifoQueue(maxsize=self.pool_size)
+			return self._pools[(scheme, host)]
+	
+	def _bucket(self, host, create=False):
+		with self._lock:
+			if host not in self._buckets and create:
+				self._buckets[host] = TokenBucket(
+				    self.max_rate or THROTTLE_START_RATE,
+				    max_rate=self.max_rate)
+			return self._buckets.get(host)
+	
+	def _throttle(self, host):
+		bucket = self._bucket(host, create=bool(self.max_rate))
+		if bucket is not None:
+			bucket.take()
+	
+	def _adapt(self, host, status, headers):
+		"""Adaptive rate: slower on 429/503, faster on successes"""
+		if status in (429, 503):
+			self._bucket(host, create=True).slow_down(retry_after(headers))
+		elif status < 400:
+			bucket = self._bucket(host)
+			if bucket is not None:
+				bucket.speed_up()
+	
+	def _proxy(self, scheme, host):
+		"""
+		Splitted proxy url for this scheme and host (or None)
+		"""
+		proxy = self.proxies.get(scheme)
+		if not proxy or proxy_bypass(urlsplit('//' + host).hostname):
+			return None
+		if '://' not in proxy:
+			proxy = 'http://' + proxy
+		return urlsplit(proxy)
+	
+	@staticmethod
+	def _proxy_auth(proxy):
+		"""
+		Proxy-Authorization header if the proxy url has user:passw@
+		"""
+		if proxy.username is None:
+			return {}
+		creds = '%s:%s' % (unquote(proxy.username),
+		                   unquote(proxy.password or ''))
+		return {'Proxy-Authorization':
+		        'Basic ' + b64encode(creds.encode('UTF-8')).decode('ascii')}
+	
+	def _new_conn(self, scheme, host):
+		proxy = self._proxy(scheme, host)
+		if proxy is None:
+			if scheme == 'https':
+				return HTTPSConnection(host, timeout=self.timeout)
+			else:
+				return HTTPConnection(host, timeout=self.timeout)
+		
+		proxy_host = proxy.hostname
+		if proxy.port:
+			proxy_host += ':%i' % proxy.port
+		if scheme == 'https':
+			# TLS with the real host inside a CONNECT tunnel
+			conn = HTTPSConnection(proxy_host, timeout=self.timeout)
+			conn.set_tunnel(host, headers=self._proxy_auth(proxy))
+			return conn
+		else:
+			return HTTPConnection(proxy_host, timeout=self.timeout)
+	
+	def _acquire(self, scheme, host):
+		"""
+		Returns (connection, was_reused)
+		"""
+		try:
+			return (self._pool(scheme, host).get_nowait(), True)
+		except Empty:
+			return (self._new_conn(scheme, host), False)
+	
+	def _release(self, scheme, host, conn):
+		try:
+			self._pool(scheme, host).put_nowait(conn)
+		except Full:
+			# already enough idle connections for this host
+			conn.close()
+	
+	def _send(self, scheme, host, selector, headers):
+		"""
+		GET request on a pooled connection => (connection, HTTPResponse)
+		"""
+		conn, was_reused = self._acquire(scheme, host)
+		try:
+			conn.request('GET', selector, headers=headers)
+			return (conn, conn.getresponse())
+		except (OSError, HTTPException) as conn_e:
+			conn.close()
+			if not was_reused:
+				raise URLError(conn_e)
+		
+		# idle connection probably closed by the server: 1 retry
+		conn = self._new_conn(scheme, host)
+		try:
+			conn.request('GET', selector, headers=headers)
+			return (conn, conn.getresponse())
+		except (OSError, HTTPException) as conn_e:
+			conn.close()
+			raise URLError(conn_e)
+	
+	def open(self, my_url, headers=None, max_redirects=5):
+		"""
+		GET my_url and return a PooledResponse (file-like object)
+		
+		The body must be read to the end (or the response closed) for
+		the connection to go back to the pool.
+		"""
+		if headers is None:
+			headers = {}
+		
+		for n_redirects in range(max_redirects + 1):
+			splitted = urlsplit(my_url)
+			scheme = splitted.scheme
+			host = splitted.netloc
+			selector = splitted.path or '/'
+			if splitted.query:
+				selector += '?' + splitted.query
+			
+			req_headers = headers
+			if scheme == 'http':
+				# plain http through a proxy: absolute url in the request
+				proxy = self._proxy(scheme, host)
+				if proxy is not None:
+					selector = 'http://' + host + selector
+					req_headers = dict(headers, **self._proxy_auth(proxy))
+			
+			self._throttle(host)
+			conn, resp = self._send(scheme, host, selector, req_headers)
+			
+			pooled = PooledResponse(resp, my_url,
+			                        lambda c=conn, s=scheme, h=host:
+			                                self._release(s, h, c),
+			                        conn.close)
+			
+			self._adapt(host, resp.status, resp.msg)
+			
+			# redirections
+			if resp.status in (301, 302, 303, 307, 308):
+				location = resp.getheader('Location')
+				pooled.read()
+				pooled.close()
+				if location is None:
+					raise HTTPError(my_url, resp.status, 'no Location',
+					                resp.msg, None)
+				new_url = urljoin(my_url, location)
+				# pas de mot de passe envoyé à un autre hôte
+				if urlsplit(new_url).netloc != host:
+					headers = {k:v for k,v in headers.items()
+					             if k.lower() != 'authorization'}
+				my_url = new_url
+				continue
+			
+			# erreurs http => même exception que urlopen
+			if resp.status >= 400:
+				body = pooled.read()
+				pooled.close()
+				raise HTTPError(my_url, resp.status, resp.reason,
+				                resp.msg, BytesIO(body))
+			
+			return pooled
+		
+		raise URLError("too many redirections for '%s'" % my_url)
+	
+	def close(self):
+		"""
+		Closes all idle connections
+		"""
+		with self._lock:
+			for pool in self._pools.values():
+				while True:
+					try:
+						pool.get_nowait().close()
+					except Empty:
+						break
+			self._pools = {}
+
+
+class PooledResponse(object):
+	"""
+	Wraps an http.client.HTTPResponse: when closed after a complete read
+	its connection returns to the session pool (otherwise it is dropped)
+	"""
+	def __init__(self, resp, url, release_fn, discard_fn):
+		self._resp = resp
+		self._release_fn = release_fn
+		self._discard_fn = discard_fn
+		self._done = False
+		self.url = url
+		self.status = resp.status
+		self.headers = resp.msg
+	
+	def read(self, amt=None):
+		return self._resp.read(amt)
+	
+	def getcode(self):
+		return self.status
+	
+	def geturl(self):
+		return self.url
+	
+	def close(self):
+		if self._done:
+			return
+		self._done = True
+		if self._resp.isclosed() and not self._resp.will_close:
+			self._release_fn()
+		else:
+			self._resp.close()
+			self._discard_fn()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exc_info):
+		self.close()
+
+
+# on-disk results
+# ---------------
+class HitStore(object):
+	"""
+	Read-only sequence of search hits kept in an sqlite file instead of RAM
+	(1 row per hit: position, id and zlib-compressed json)
+	
+	Behaves like the hits list returned by search():
+	    len(store), store[i], store[i:j], for hit in store: ...
+	plus a lookup by ISTEX id:
+	    store.get('F6E41E226B3EAA27E5BC4D76C0FDCEC30AC92984')
+	
+	Without *db_path* a temporary file is used and removed on close().
+	With truncate=True the previous hits of a db_path file are removed,
+	otherwise extend() appends to them.
+	
+	A store can be used from other threads than the one that filled it.
+	"""
+	def __init__(self, db_path=None, truncate=False):
+		self._is_tmp = db_path is None
+		if self._is_tmp:
+			fd, db_path = mkstemp(prefix='istex-', suffix='.hits.sqlite')
+			close(fd)
+		self.path = db_path
+		self._lock = Lock()
+		self._db = sqlite3.connect(db_path, check_same_thread=False)
+		self._db.execute("CREATE TABLE IF NOT EXISTS hits (pos INTEGER PRIMARY KEY, id TEXT, doc BLOB)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS hits_id ON hits (id)")
+		if truncate:
+			self._db.execute("DELETE FROM hits")
+			self._db.commit()
+		self._len = self._db.execute("SELECT COUNT(*) FROM hits").fetchone()[0]
+	
+	def extend(self, hits, batch_size=PAGE_SIZE):
+		"""
+		Appends hits from any iterable (ex: an iter_search generator)
+		"""
+		batch = []
+		for hit in hits:
+			batch.append((hit.get('id'),
+			              compress(dumps(hit).encode('UTF-8'), 1)))
+			if len(batch) >= batch_size:
+				self._insert(batch)
+				batch = []
+		if batch:
+			self._insert(batch)
+	
+	def _insert(self, batch):
+		with self._lock:
+			self._db.executemany("INSERT INTO hits VALUES (?,?,?)",
+			                     [(self._len + i, idi, blob)
+			                      for i, (idi, blob) in enumerate(batch)])
+			self._db.commit()
+			self._len += len(batch)
+	
+	def _fetchone(self, sql, params):
+		with self._lock:
+			return self._db.execute(sql, params).fetchone()
+	
+	@staticmethod
+	def _load(blob):
+		return loads(decompress(blob).decode('UTF-8'))
+	
+	def __len__(self):
+		return self._len
+	
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(self._len))]
+		if i < 0:
+			i += self._len
+		if not 0 <= i < self._len:
+			raise IndexError("HitStore index out of range")
+		row = self._fetchone("SELECT doc FROM hits WHERE pos=?", (i,))
+		return self._load(row[0])
+	
+	def __iter__(self):
+		# by pages of positions: no cursor kept open between 2 yields
+		for start in range(0, self._len, 1000):
+			with self._lock:
+				rows = self._db.execute("SELECT doc FROM hits WHERE pos>=? AND pos<? ORDER BY pos",
+				                        (start, start + 1000)).fetchall()
+			for row in rows:
+				yield self._load(row[0])
+	
+	def get(self, istex_id, default=None):
+		"""
+		The hit with this id (or default)
+		"""
+		row = self._fetchone("SELECT doc FROM hits WHERE id=?", (istex_id,))
+		return self._load(row[0]) if row else default
+	
+	def close(self):
+		if self._db is not None:
+			with self._lock:
+				self._db.close()
+				self._db = None
+			if self._is_tmp and path.exists(self.path):
+				remove(self.path)
+	
+	def __del__(self):
+		self.close()
+
+
+class ResponseCache(object):
+	"""
+	Persistent cache of the API json responses (count, facet, search)
+	
+	  - sqlite file keyed on the normalized url (sorted query params)
+	  - entries older than *ttl* seconds are ignored
+	  - at most *max_entries* rows: least recently used ones are evicted
+	  - bypass=True: nothing is read or written
+	
+	The sqlite file is only created at first use (thread-safe).
+	
+	Fails open: if the file can't be created or used (read-only dir,
+	locked db...) a warning is printed and the cache is bypassed.
+	"""
+	def __init__(self, db_path=CACHE_PATH, ttl=CACHE_TTL,
+	             max_entries=CACHE_MAX_ENTRIES, bypass=False):
+		self.path = db_path
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.bypass = bypass
+		self._db = None
+		self._n_entries = 0
+		self._lock = Lock()
+	
+	@staticmethod
+	def normalize(my_url):
+		"""
+		Same key for the same query whatever the params order
+		"""
+		splitted = urlsplit(my_url)
+		params = '&'.join(sorted(splitted.query.split('&')))
+		return (splitted.scheme.lower() + '://' + splitted.netloc.lower()
+		        + splitted.path + '?' + params)
+	
+	def _connect(self):
+		if self._db is None:
+			cache_dir = path.dirname(self.path)
+			if cache_dir and not path.exists(cache_dir):
+				makedirs(cache_dir)
+			self._db = sqlite3.connect(self.path, check_same_thread=False)
+			self._db.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, stamp REAL, used REAL, body BLOB)")
+			self._db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+			self._n_entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+		return self._db
+	
+	def _fail(self, db_e):
+		"""
+		Bypasses the cache from now on (called with the lock held)
+		"""
+		print("api: WARN response cache disabled (%s: %s)"
+		      % (self.path, db_e), file=stderr)
+		self.bypass = True
+		if self._db is not None:
+			try:
+				self._db.close()
+			except sqlite3.Error:
+				pass
+			self._db = None
+	
+	def get(self, my_url):
+		"""
+		Cached response body (bytes) or None if absent or expired
+		"""
+		if self.bypass:
+			return None
+		key = self.normalize(my_url)
+		now = time()
+		with self._lock:
+			try:
+				db = self._connect()
+				row = db.execute("SELECT stamp, body FROM responses WHERE url=?", (key,)).fetchone()
+				if row is None or now - row[0] > self.ttl:
+					return None
+				db.execute("UPDATE responses SET used=? WHERE url=?", (now, key))
+				db.commit()
+				return row[1]
+			except (OSError, sqlite3.Error) as db_e:
+				self._fail(db_e)
+				return None
+	
+	def put(self, my_url, body):
+		if self.bypass:
+			return
+		with self._lock:
+			try:
+				self._put(my_url, body)
+			except (OSError, sqlite3.Error) as db_e:
+				self._fail(db_e)
+	
+	def _put(self, my_url, body):
+		"""put() with the lock held"""
+		key = self.normalize(my_url)
+		now = time()
+		db = self._connect()
+		if db.execute("SELECT 1 FROM responses WHERE url=?", (key,)).fetchone() is None:
+			self._n_entries += 1
+		db.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?)", (key, now, now, body))
+		# éviction LRU (par lots de 10% pour ne pas le faire à chaque fois)
+		if self.max_entries and self._n_entries > self.max_entries:
+			n_evicted = self._n_entries - int(self.max_entries * .9)
+			db.execute("DELETE FROM responses WHERE url IN (SELECT url FROM responses ORDER BY used LIMIT ?)", (n_evicted,))
+			self._n_entries -= n_evicted
+		db.commit()
+	
+	def clear(self):
+		with self._lock:
+			try:
+				self._connect().execute("DELETE FROM responses")
+				self._db.commit()
+				self._n_entries = 0
+			except (OSError, sqlite3.Error) as db_e:
+				self._fail(db_e)
+	
+	def close(self):
+		with self._lock:
+			if self._db is not None:
+				self._db.close()
+				self._db = None
+
+
+# module-level session shared by all the api calls
+SESSION = HTTPSession()
+
+def set_session(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                max_rate=DEFAULT_MAX_RATE, proxies=None):
+	"""
+	Replaces the shared session (ex: for a bigger pool if many threads)
+	"""
+	global SESSION
+	SESSION.close()
+	SESSION = HTTPSession(pool_size=pool_size, timeout=timeout,
+	                      max_rate=max_rate, proxies=proxies)
+
+
+# module-level response cache used by _get()
+RESPONSE_CACHE = ResponseCache()
+
+def set_response_cache(db_path=CACHE_PATH, ttl=CACHE_TTL,
+                       max_entries=CACHE_MAX_ENTRIES, bypass=False):
+	"""
+	Replaces the shared response cache (ex: bypass=True for fresh counts)
+	"""
+	global RESPONSE_CACHE
+	RESPONSE_CACHE.close()
+	RESPONSE_CACHE = ResponseCache(db_path=db_path, ttl=ttl,
+	                               max_entries=max_entries, bypass=bypass)
+
+
+# retries
+# -------
+def retry_after(headers):
+	"""
+	Seconds to wait according to a Retry-After header (or None)
+	(value in seconds or http date, capped at BACKOFF_MAX so that an
+	 odd header can't stall the workers indefinitely)
+	"""
+	if headers is None:
+		return None
+	value = headers.get('Retry-After')
+	if value is None:
+		return None
+	value = value.strip()
+	if value.isdigit():
+		return min(BACKOFF_MAX, float(value))
+	try:
+		return min(BACKOFF_MAX,
+		           max(0.0, parsedate_to_datetime(value).timestamp() - time()))
+	except (TypeError, ValueError, OverflowError):
+		return None
+
+
+def is_transient(url_e):
+	"""
+	Is it worth retrying? (network errors, 429 and 5xx gateway errors)
+	"""
+	if isinstance(url_e, HTTPError):
+		return url_e.getcode() in TRANSIENT_CODES
+	else:
+		return True
+
+
+def backoff_delay(attempt, url_e=None):
+	"""
+	Seconds to wait before retry no *attempt* + 1:
+	the server's Retry-After if any, otherwise an exponential backoff
+	with jitter (so that parallel threads don't retry all together)
+	"""
+	if isinstance(url_e, HTTPError):
+		server_delay = retry_after(url_e.headers)
+		if server_delay is not None:
+			return server_delay
+	
+	delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+	return uniform(delay / 2, delay)
+
+
 # private function
 # ----------------
-def _get(my_url):
+def _get(my_url, use_cache=True):
 	"""
 	Get remote url *that contains a ~json~* 
 	and parse it
+	
+	(the response can come from RESPONSE_CACHE unless use_cache=False)
 	"""
 	
 	# print("> api._get:%s" % my_url, file=stderr)
 	
-	try:
-		remote_file = urlopen(my_url)
+	if use_cache:
+		cached = RESPONSE_CACHE.get(my_url)
+		if cached is not None:
+			return loads(cached.decode('UTF-8'))
+	
+	for attempt in range(RETRIES + 1):
+		try:
+			remote_file = SESSION.open(my_url)
+			
+		except URLError as url_e:
+			# erreurs transitoires (réseau, 429, 502...) => on réessaye
+			if is_transient(url_e) and attempt < RETRIES:
+				delay = backoff_delay(attempt, url_e)
+				print("api: retry %i/%i in %.1fs (%s) sur '%s'" %
+					(attempt+1, RETRIES, delay, url_e.reason, my_url),
+					file=stderr)
+				sleep(delay)
+				continue
+			
+			# signale 401 Unauthorized ou 404 etc
+			print("api: HTTP ERR (%s) sur '%s'" % 
+				(url_e.reason, my_url), file=stderr)
+			# Plus d'infos: serveur, Content-Type, WWW-Authenticate..
+			# print ("ERR.info(): \n %s" % url_e.info(), file=stderr)
+			exit(1)
 		
-	except URLError as url_e:
-		# signale 401 Unauthorized ou 404 etc
-		print("api: HTTP ERR (%s) sur '%s'" % 
-			(url_e.reason, my_url), file=stderr)
-		# Plus d'infos: serveur, Content-Type, WWW-Authenticate..
-		# print ("ERR.info(): \n %s" % url_e.info(), file=stderr)
-		exit(1)
-	try:
-		response = remote_file.read()
-	except httplib.IncompleteRead as ir_e:
-		response = ir_e.partial
-		print("WARN: IncompleteRead '%s' but 'partial' content has page" 
-				% my_url, file=stderr)
-	remote_file.close()
+		complete = True
+		try:
+			response = remote_file.read()
+		except (OSError, HTTPException) as read_e:
+			# coupure en cours de lecture (IncompleteRead, timeout, reset)
+			remote_file.close()
+			if attempt < RETRIES:
+				delay = backoff_delay(attempt)
+				print("api: retry %i/%i in %.1fs (%r) sur '%s'" %
+					(attempt+1, RETRIES, delay, read_e, my_url),
+					file=stderr)
+				sleep(delay)
+				continue
+			if not isinstance(read_e, IncompleteRead):
+				print("api: HTTP ERR (%r) sur '%s'" % (read_e, my_url),
+				      file=stderr)
+				exit(1)
+			response = read_e.partial
+			complete = False
+			print("WARN: IncompleteRead '%s' but 'partial' content has page" 
+					% my_url, file=stderr)
+		remote_file.close()
+		break
+	
 	result_str = response.decode('UTF-8')
 	json_values = loads(result_str)
+	
+	if use_cache and complete:
+		RESPONSE_CACHE.put(my_url, response)
+	
 	return json_values
 
 
-def _bget(my_url, user=None, passw=None):
+def _bopen(my_url, user=None, passw=None):
 	"""
-	Get remote auth-protected url *that contains a ~file~* 
-	and pass its binary data straight from remote response
-	(for instance when retrieving fulltext from ISTEX API)
+	Open remote auth-protected url *that contains a ~file~*
+	
+	Returns the opened response (or None for a 404 etc.)
+	Raises AuthWarning if the API wants an authentification.
 	"""
 	
 	# /!\ attention le password est en clair ici /!\
 	# print ("REGARD:", user, passw,     file=stderr)
 	
-	no_contents = False
-	
-	auth_handler = HTTPBasicAuthHandler()
-	auth_handler.add_password(
-			realm  = 'Authentification sur api.istex.fr',
-			uri    = 'https://api.istex.fr',
-			user   = user,
-			passwd = passw)
-	install_opener(build_opener(auth_handler))
+	# basic auth header (realm 'Authentification sur api.istex.fr')
+	headers = {}
+	if user is not None:
+		credentials = b64encode(('%s:%s' % (user, passw)).encode('UTF-8'))
+		headers['Authorization'] = 'Basic ' + credentials.decode('ascii')
 	
 	print("GET bin (user:%s)" % user, file=stderr)
 	
 	# contact
 	try:
-		remote_file = urlopen(my_url)
+		return SESSION.open(my_url, headers=headers)
 		
-	except URLError as url_e:
+	except HTTPError as url_e:
 		if url_e.getcode() == 401:
 			raise AuthWarning("need_auth")
+		elif is_transient(url_e):
+			# erreur serveur ou 429 (transitoire) => à l'appelant de réessayer
+			raise
 		else:
 			# 404 à gérer *sans quitter* pour les fulltexts en nombre...
-			no_contents = True
 			print("api: HTTP ERR no %i (%s) sur '%s'" % 
 				(url_e.getcode(),url_e.msg, my_url), file=stderr)
 				# pour + de détail
 				# print ("ERR.info(): \n %s" % url_e.info(),file=stderr)
+			return None
+
+
+def _bget(my_url, user=None, passw=None):
+	"""
+	Get remote auth-protected url *that contains a ~file~* 
+	and pass its binary data straight from remote response
+	(for instance when retrieving fulltext from ISTEX API)
+	"""
+	remote_file = _bopen(my_url, user=user, passw=passw)
 	
-	if no_contents:
+	if remote_file is None:
 		return None
 	else:
 		# lecture
@@ -109,10 +826,132 @@ def _bget(my_url, user=None, passw=None):
 		return contents
 
 
+def _bstream(my_url, tgt_path, user=None, passw=None, checksum=True, chunk_size=CHUNK_SIZE):
+	"""
+	Like _bget but copies the remote file to tgt_path by chunks
+	(constant memory, even for big PDFs or ZIPs)
+	
+	The data goes to a temporary file in the same dir, renamed to
+	tgt_path only when complete (no truncated file on failures).
+	
+	Returns (n_bytes, hex sha1 or None) or None for a 404 etc.
+	"""
+	remote_file = _bopen(my_url, user=user, passw=passw)
+	
+	if remote_file is None:
+		return None
+	
+	hasher = sha1() if checksum else None
+	n_bytes = 0
+	
+	tmp_fh = NamedTemporaryFile(dir=path.dirname(path.abspath(tgt_path)),
+	                            prefix='.part-', delete=False)
+	try:
+		try:
+			while True:
+				chunk = remote_file.read(chunk_size)
+				if not chunk:
+					break
+				tmp_fh.write(chunk)
+				n_bytes += len(chunk)
+				if hasher:
+					hasher.update(chunk)
+		except (OSError, HTTPException) as read_e:
+			# coupure en cours de route => même traitement que les autres
+			# erreurs réseau (l'appelant peut réessayer)
+			raise URLError(read_e)
+		finally:
+			remote_file.close()
+			tmp_fh.close()
+		replace(tmp_fh.name, tgt_path)
+	except BaseException:
+		remove(tmp_fh.name)
+		raise
+	
+	return (n_bytes, hasher.hexdigest() if hasher else None)
+
+
+# url builders (shared with aioapi)
+# ------------
+def query_url(url_encoded_lucene_query, api_conf=DEFAULT_API_CONF):
+	"""
+	Base URL of a lucene query (the query must be already escaped)
+	"""
+	return 'https:' + '//' + api_conf['host']  + '/' + api_conf['route'] + '/' + '?' + 'q=' + url_encoded_lucene_query
+
+
+def count_url(q, api_conf=DEFAULT_API_CONF, already_escaped=False):
+	"""URL for the total hits of a query (cf. count)"""
+	if already_escaped:
+		url_encoded_lucene_query = q
+	else:
+		url_encoded_lucene_query = my_url_quoting(q)
+	
+	return query_url(url_encoded_lucene_query, api_conf) + '&size=1'
+
+
+def search_url(q, api_conf=DEFAULT_API_CONF, outfields=('title','host.issn','fulltext'), size=PAGE_SIZE, scroll=None, random_seed=None):
+	"""
+	URL for a page of hits (cf. search and iter_search)
+	
+	with scroll (ex: '1m') => first page of a scroll cursor
+	"""
+	my_url = query_url(quote(q), api_conf) + '&output=' + ",".join(outfields) + '&size=%i' % size
+	
+	if scroll is not None:
+		my_url += '&scroll=' + scroll
+	
+	# tri aléatoire (reproductible)
+	if random_seed is not None:
+		my_url += '&rankBy=random&randomSeed=%i' % random_seed
+	
+	return my_url
+
+
+def facet_url(facet_name, q="*", api_conf=DEFAULT_API_CONF):
+	"""URL for the terms facet of a field (cf. terms_facet)"""
+	return query_url(my_url_quoting(q), api_conf) + '&facet=' + facet_name
+
+
+def fulltext_url(DID, api_type, api_conf=DEFAULT_API_CONF):
+	"""URL of a document's file (ex: api_type 'fulltext/pdf')"""
+	return 'https://'+api_conf['host']+'/'+api_conf['route']+'/'+DID+'/'+api_type
+
+
+def facet_counts(json_values, facet_name, with_other=False):
+	"""
+	Simplified terms facet from the parsed API json (cf. terms_facet)
+	"""
+	aggregation = json_values['aggregations'][facet_name]
+	key_counts = aggregation['buckets']
+	
+	
+	# simplification de la structure
+	# [
+	#  {'docCount': 8059500, 'key': 'eng'},
+	#  {'docCount': 1138473, 'key': 'deu'}
+	# ]
+	# => sortie + compacte:
+	#    {'eng': 8059500, 'deu': 1138473 }
+	simple_dict = {}
+	for record in key_counts:
+		k = record['key']
+		n = record['docCount']
+		
+		simple_dict[k] = n
+	
+	if with_other:
+		# valeurs hors liste si la liste est tronquée
+		n_other = aggregation.get('sumOtherDocCount',
+		                          aggregation.get('sum_other_doc_count'))
+		return (simple_dict, n_other)
+	else:
+		return simple_dict
+
+
 # public functions
 # ----------------
-# £TODO: stockage disque sur fichier tempo si liste grande et champx nbx
-def search(q, api_conf=DEFAULT_API_CONF, limit=None, outfields=('title','host.issn','fulltext')):
+def search(q, api_conf=DEFAULT_API_CONF, limit=None, outfields=('title','host.issn','fulltext'), spill_threshold=SPILL_THRESHOLD, spill_path=None, random_seed=None):
 	"""
 	Query the API and get a (perhaps long) "hits" array of json metadata.
 
@@ -128,6 +967,13 @@ def search(q, api_conf=DEFAULT_API_CONF, limit=None, outfields=('title','host.is
 	   api_conf    -- an inherited http config dict with these 2 keys:
 	                    * api_conf['host']   <- default: "api.istex.fr"
 	                    * api_conf['route']  <- default: "document"
+	   spill_threshold -- above this number of hits, they are stored on
+	                      disk and a HitStore is returned instead of a list
+	                      (same usage: len, [i], iteration) (None: never)
+	   spill_path  -- optional sqlite file path for the HitStore
+	                  (default: a temporary file)
+	   random_seed -- int: hits in a random order (rankBy=random) that
+	                  is always the same for the same seed
 
 	Output format is a parsed json with a total value and a hit list:
 	{ 'hits': [ { 'id': '21B88F4EFBA46DC85E863709CA9824DEED7B7BFC',
@@ -142,68 +988,107 @@ def search(q, api_conf=DEFAULT_API_CONF, limit=None, outfields=('title','host.is
 	url_encoded_lucene_query = quote(q)
 	
 	# décompte à part
-	n_docs = count(url_encoded_lucene_query, already_escaped=True)
+	n_docs = count(url_encoded_lucene_query, api_conf=api_conf, already_escaped=True)
 	# print('%s documents trouvés' % n_docs)
 	
-	# construction de l'URL
-	base_url = 'https:' + '//' + api_conf['host']  + '/' + api_conf['route'] + '/' + '?' + 'q=' + url_encoded_lucene_query + '&output=' + ",".join(outfields)
-	# debug
-	# print("api.search().base_url:", base_url)
-	
 	# limitation éventuelle fournie par le switch --maxi
 	if limit is not None:
-		n_docs = limit
+		n_docs = min(limit, n_docs)
 	
 	# la liste des résultats à renvoyer
 	all_hits = []
 	
 	# ensuite 2 cas de figure : 1 requête ou plusieurs
-	if n_docs <= 5000:
+	if n_docs <= PAGE_SIZE:
 		# requête simple
-		my_url = base_url + '&size=%i' % n_docs
+		my_url = search_url(q, api_conf, outfields, size=n_docs,
+		                    random_seed=random_seed)
 		json_values = _get(my_url)
 		all_hits = json_values['hits']
 	
 	else:
-		# requêtes paginées pour les tailles > 5000
+		# requêtes paginées pour les tailles > PAGE_SIZE (via scroll)
 		print("Collecting result hits... ", file=stderr)
-		for k in range(0, n_docs, 5000):
-			print("%i..." % k, file=stderr)
-			my_url = base_url + '&size=5000' + "&from=%i" % k
-			json_values = _get(my_url)
-			all_hits += json_values['hits']
+		hits_iterator = iter_search(q, api_conf=api_conf, limit=n_docs,
+		                            outfields=outfields,
+		                            random_seed=random_seed)
 		
-		# TODO stocker si > RAM/5
-		
-		# si on avait une limite par ex 7500 et qu'on est allés jusqu'à 10000
-		all_hits = all_hits[0:n_docs]
+		if spill_threshold is not None and n_docs > spill_threshold:
+			# stockage disque pour les très grands résultats
+			# (a new query: no hits left from a previous spill_path use)
+			all_hits = HitStore(spill_path, truncate=True)
+			all_hits.extend(hits_iterator)
+		else:
+			all_hits = list(hits_iterator)
 	
 	return(all_hits)
 
 
-def count(q, api_conf=DEFAULT_API_CONF, already_escaped=False):
+def iter_search(q, api_conf=DEFAULT_API_CONF, limit=None, outfields=('title','host.issn','fulltext'), page_size=PAGE_SIZE, scroll=SCROLL_TTL, random_seed=None):
 	"""
-	Get total hits for a lucene query on ISTEX api.
+	Generator over the hits of a query (same args as search())
+	
+	Uses the API scroll cursor: one request per page of *page_size*
+	hits, each following the previous page's 'nextScrollURI'. Hence
+	only one page is in memory at a time and deep pages don't cost more
+	than the first ones (unlike from=k pagination).
+	
+	   for hit in iter_search("corpusName:nature", outfields=['id']):
+	       print(hit['id'])
 	"""
-	# préparation requête
-	if already_escaped:
-		url_encoded_lucene_query = q
-	else:
-		url_encoded_lucene_query = my_url_quoting(q)
+	if limit is not None and limit < page_size:
+		page_size = limit
+	
+	# construction de l'URL de la première page
+	my_url = search_url(q, api_conf, outfields, size=page_size,
+	                    scroll=scroll, random_seed=random_seed)
 	
-	# construction de l'URL
-	count_url = 'https:' + '//' + api_conf['host']  + '/' + api_conf['route'] + '/' + '?' + 'q=' + url_encoded_lucene_query + '&size=1'
+	n_yielded = 0
+	while my_url:
+		# pas de cache: les curseurs scroll ne vivent que SCROLL_TTL
+		json_values = _get(my_url, use_cache=False)
+		hits = json_values.get('hits', [])
+		
+		for hit in hits:
+			if limit is not None and n_yielded >= limit:
+				return
+			yield hit
+			n_yielded += 1
+		
+		if not hits or json_values.get('noMoreScrollResults'):
+			break
+		
+		# page suivante: curseur fourni par l'API
+		my_url = json_values.get('nextScrollURI')
+
+
+def count(q, api_conf=DEFAULT_API_CONF, already_escaped=False, use_cache=True):
+	"""
+	Get total hits for a lucene query on ISTEX api.
 	
+	(use_cache=False to bypass the RESPONSE_CACHE)
+	"""
 	# requête
-	json_values = _get(count_url)
+	json_values = _get(count_url(q, api_conf, already_escaped),
+	                   use_cache=use_cache)
 	
 	return int(json_values['total'])
 
 
-def write_fulltexts(DID, base_name=None, api_conf=DEFAULT_API_CONF, tgt_dir='.', login=None, passw=None, api_types=['fulltext/pdf', 'metadata/xml']):
+def fulltext_path(base_name, api_type, tgt_dir='.'):
+	"""
+	Local path for a document's fulltext or metadata file:
+	the extension is the right part of the api route (ex: 'pdf')
+	"""
+	return path.join(tgt_dir, base_name+'.'+api_type.split('/')[1])
+
+
+def write_fulltexts(DID, base_name=None, api_conf=DEFAULT_API_CONF, tgt_dir='.', login=None, passw=None, api_types=['fulltext/pdf', 'metadata/xml'], manifest=None):
 	"""
 	Get XML metas, TEI, PDF, ZIP fulltexts etc. for a given ISTEX-API document.
 	
+	If a *manifest* is provided (cf. corpusdirs.DownloadManifest), files
+	it reports as complete are skipped and new ones are recorded in it.
 	"""
 	# vérification
 	for at in api_types:
@@ -220,132 +1105,189 @@ def write_fulltexts(DID, base_name=None, api_conf=DEFAULT_API_CONF, tgt_dir='.',
 	if not base_name:
 		base_name = DID
 	
-	# préparation requête
-	da_url = 'https://'+api_conf['host']+'/'+api_conf['route']+'/'+DID
-	
 	for at in api_types:
-			response = _bget(da_url+'/'+at, user=login, passw=passw)
+			# ext par défaut: partie droite de la route de l'api
+			tgt_path = fulltext_path(base_name, at, tgt_dir)
+			
+			if manifest is not None and manifest.is_complete(tgt_path):
+				continue
 			
-			# _bget renvoie None pour les (rares) 404 
+			# copie directe vers le disque
+			written = _bstream(fulltext_url(DID, at, api_conf), tgt_path,
+			                   user=login, passw=passw,
+			                   checksum=(manifest is not None))
+			
+			# _bstream renvoie None pour les (rares) 404 
 			#      (ex: demande tei a ecco)
-			if response is not None:
-				
-				# ext par défaut: partie droite de la route de l'api
-				ext = at.split('/')[1]
-				
-				tgt_path = path.join(tgt_dir, base_name+'.'+ext)
-				
-				fh = open(tgt_path, 'wb')
-				fh.write(response)
-				fh.close()
+			if written is not None:
+				if manifest is not None:
+					manifest.record(tgt_path, 'ok', written[0], written[1])
+			
+			elif manifest is not None:
+				manifest.record(tgt_path, 'absent')
 
 
-def write_fulltexts_loop_interact(list_of_ids, list_of_basenames=None, api_conf=DEFAULT_API_CONF, tgt_dir='.', api_types=['fulltext/pdf', 'metadata/xml']):
+def _write_fulltexts_retry(DID, base_name=None, api_conf=DEFAULT_API_CONF, tgt_dir='.', login=None, passw=None, api_types=['fulltext/pdf', 'metadata/xml'], retries=DOWNLOAD_RETRIES, manifest=None):
 	"""
-	Calls the preceding function in a loop for an entire list,
+	write_fulltexts() with a retry on transient errors (network, 429, 5xx)
+	after a backoff delay (cf. backoff_delay)
+	
+	Returns True if the doc was processed, False if all attempts failed.
+	"""
+	for attempt in range(retries + 1):
+		try:
+			write_fulltexts(
+				DID,
+				base_name = base_name,
+				api_conf  = api_conf,
+				tgt_dir   = tgt_dir,
+				login     = login,
+				passw     = passw,
+				api_types = api_types,
+				manifest  = manifest
+			)
+			return True
+		except URLError as url_e:
+			if attempt < retries and is_transient(url_e):
+				delay = backoff_delay(attempt, url_e)
+				print("api: retry %i/%i in %.1fs for doc %s (%s)" %
+				      (attempt+1, retries, delay, DID, url_e.reason),
+				      file=stderr)
+				sleep(delay)
+			else:
+				print("api: giving up on doc %s (%s)" % (DID, url_e.reason),
+				      file=stderr)
+				return False
+	return False
+
+
+def write_fulltexts_loop_interact(list_of_ids, list_of_basenames=None, api_conf=DEFAULT_API_CONF, tgt_dir='.', api_types=['fulltext/pdf', 'metadata/xml'], workers=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES, manifest=None):
+	"""
+	Calls the preceding function for an entire list,
+	with a pool of *workers* download threads
 	
 	With optional interactive authentification step:
 	  - IF (login and passw are None AND _bget raises AuthWarning)
-	    THEN ask user
+	    THEN ask user (once: the credentials are shared by all workers)
+	
+	Each doc is retried up to *retries* times on transient errors.
+	
+	With a *manifest*, docs whose files are all complete are skipped
+	(resumed downloads).
 	
+	Returns the list of IDs that could not be retrieved.
 	"""
-	# test sur le premier fichier: authentification est-elle nécessaire ?
-	need_auth = False
+	if not list_of_basenames:
+		list_of_basenames = list_of_ids
 	
-	first_doc_id = list_of_ids[0]
-	if list_of_basenames:
-		first_base_name = list_of_basenames[0]
-	else:
-		first_base_name = None
+	# reprise: on ne garde que les docs encore incomplets
+	if manifest is not None:
+		todo = [i for i, bname in enumerate(list_of_basenames)
+		          if not all(manifest.is_complete(fulltext_path(bname, at, tgt_dir))
+		                     for at in api_types)]
+		if len(todo) < len(list_of_ids):
+			print("API: %i docs already complete (skipped)"
+			       % (len(list_of_ids) - len(todo)), file=stderr)
+		list_of_ids = [list_of_ids[i] for i in todo]
+		list_of_basenames = [list_of_basenames[i] for i in todo]
+	
+	n_docs = len(list_of_ids)
+	if not n_docs:
+		return []
 	
+	# test sur le premier fichier: authentification est-elle nécessaire ?
+	my_login = None
+	my_passw = None
+	first_ok = False
 	try:
 		# test with no auth credentials
-		write_fulltexts(
-			first_doc_id, first_base_name, 
+		first_ok = _write_fulltexts_retry(
+			list_of_ids[0], list_of_basenames[0],
+			api_conf=api_conf,
 			tgt_dir=tgt_dir,
-			api_types=api_types
+			api_types=api_types,
+			retries=retries,
+			manifest=manifest
 			)
 		print("API:retrieving doc no 1 from %s" % api_types)
 	except AuthWarning as e:
 		print("NB: l'API veut une authentification pour les fulltexts SVP...",
 				file=stderr)
-		need_auth = True
-	
-	# récupération avec ou sans authentification
-	if need_auth:
-		my_login = input(' => Nom d\'utilisateur "ia": ')
-		my_passw = getpass(prompt=' => Mot de passe: ')
-		for i, did in enumerate(list_of_ids):
-			if list_of_basenames:
-				my_bname = list_of_basenames[i]
-			else:
-				my_bname = None
-			
-			print("API:retrieving doc no %s from %s" % (str(i+1),api_types))
+		# demande et vérification sur le même premier doc
+		while True:
+			my_login = input(' => Nom d\'utilisateur "ia": ')
+			my_passw = getpass(prompt=' => Mot de passe: ')
 			try:
-				write_fulltexts(
-					did,
-					base_name = my_bname,
+				first_ok = _write_fulltexts_retry(
+					list_of_ids[0], list_of_basenames[0],
+					api_conf=api_conf,
 					tgt_dir=tgt_dir,
 					login=my_login,
 					passw=my_passw,
-					api_types= api_types
-				)
+					api_types=api_types,
+					retries=retries,
+					manifest=manifest
+					)
+				print("API:retrieving doc no 1 from %s" % api_types)
+				break
 			except AuthWarning as e:
 				print("authentification refusée :(")
-				my_login = input(' => Nom d\'utilisateur "ia": ')
-				my_passw = getpass(prompt=' => Mot de passe: ')
 	
-	else:
-		for i, did in enumerate(list_of_ids):
-			# on ne refait pas le 1er car il a marché
-			if i == 0:
-				continue
-			if list_of_basenames:
-				my_bname = list_of_basenames[i]
-			else:
-				my_bname = None
-			print("API:retrieving doc no %s from %s" % (str(i+1),api_types))
-			write_fulltexts(
-				did,
-				base_name=my_bname,
-				tgt_dir=tgt_dir,
-				api_types=api_types
+	failed_ids = [] if first_ok else [list_of_ids[0]]
+	
+	# tous les autres docs en parallèle avec les mêmes identifiants
+	def one_doc(i):
+		try:
+			return _write_fulltexts_retry(
+				list_of_ids[i],
+				base_name = list_of_basenames[i],
+				api_conf  = api_conf,
+				tgt_dir   = tgt_dir,
+				login     = my_login,
+				passw     = my_passw,
+				api_types = api_types,
+				retries   = retries,
+				manifest  = manifest
 			)
+		except AuthWarning as e:
+			print("api: authentification refusée pour le doc %s" % list_of_ids[i],
+			      file=stderr)
+			return False
+	
+	n_done = 1
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(one_doc, i):i for i in range(1, n_docs)}
+		for fut in as_completed(futures):
+			n_done += 1
+			if not fut.result():
+				failed_ids.append(list_of_ids[futures[fut]])
+			print("API:retrieved doc %i/%i from %s" % (n_done, n_docs, api_types))
+	
+	if failed_ids:
+		print("API: %i docs could not be retrieved" % len(failed_ids),
+		      file=stderr)
+	
+	return failed_ids
 
 
-def terms_facet(facet_name, q="*", api_conf=DEFAULT_API_CONF):
+def terms_facet(facet_name, q="*", api_conf=DEFAULT_API_CONF, use_cache=True, with_other=False):
 	"""
 	Get list of possible values/outcomes for a given field, with their counts (within the perimeter of the query q).
 	
-	output format {"facet_value_1": count_1, ...}
-	"""
-	# préparation requête
-	url_encoded_lucene_query = my_url_quoting(q)
+	(use_cache=False to bypass the RESPONSE_CACHE)
 	
-	# construction de l'URL
-	facet_url = 'https:' + '//' + api_conf['host']  + '/' + api_conf['route'] + '/' + '?' + 'q=' + url_encoded_lucene_query + '&facet=' + facet_name
+	output format {"facet_value_1": count_1, ...}
 	
+	with_other=True => output is a pair (simple_dict, n_other) where
+	                   n_other counts the docs with values left out of
+	                   the (truncated) buckets list, or is None if the
+	                   API doesn't tell
+	"""
 	# requête
-	json_values = _get(facet_url)
-	key_counts = json_values['aggregations'][facet_name]['buckets']
-	
-	
-	# simplification de la structure
-	# [
-	#  {'docCount': 8059500, 'key': 'eng'},
-	#  {'docCount': 1138473, 'key': 'deu'}
-	# ]
-	# => sortie + compacte:
-	#    {'eng': 8059500, 'deu': 1138473 }
-	simple_dict = {}
-	for record in key_counts:
-		k = record['key']
-		n = record['docCount']
-		
-		simple_dict[k] = n
+	json_values = _get(facet_url(facet_name, q, api_conf),
+	                   use_cache=use_cache)
 	
-	return simple_dict
+	return facet_counts(json_values, facet_name, with_other)
 
 
 def my_url_quoting(a_query):
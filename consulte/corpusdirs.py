@@ -13,13 +13,18 @@ __version__   = "0.3"
 __email__     = "romain.loth@inist.fr"
 __status__    = "Dev"
 
-from os              import path, mkdir, rename
-from shutil          import rmtree, move
-from re              import match, search, sub, escape, MULTILINE
+import os
+from os              import path, mkdir, cpu_count, fstat, replace, remove
+from shutil          import copyfileobj
+from codecs          import getincrementaldecoder
+from re              import match, search, sub, MULTILINE
 from csv             import DictReader
 from collections     import defaultdict
-from subprocess      import call
 from json            import dump, load
+from hashlib         import sha1
+from threading       import Lock
+from concurrent.futures import ProcessPoolExecutor
+from itertools       import repeat
 
 # pour utilisation autonome
 # corpusdirs.py new_corpus_name -t info_table.tsv
@@ -33,6 +38,7 @@ try:
 	#          au sein d'un package plus grand (exemple: bib-adapt-corpus)
 	from libconsulte import api
 	from libconsulte import field_value_lists
+	from libconsulte import xslt
 	# =<< target_language_values, target_scat_values,
 	#     target_genre_values, target_date_ranges
 except ImportError:
@@ -41,10 +47,11 @@ except ImportError:
 		#           exemple: on veut juste lancer le sampler tout seul
 		import api
 		import field_value_lists
+		import xslt
 		
 	# cas de figure où il n'y a vraiment rien
 	except ImportError:
-		print("ERR: Les modules 'api.py' et 'field_value_lists.py' doivent être placés à côté du script corpusdirs.py ou dans un dossier du PYTHONPATH, pour sa bonne execution...")
+		print("ERR: Les modules 'api.py', 'field_value_lists.py' et 'xslt.py' doivent être placés à côté du script corpusdirs.py ou dans un dossier du PYTHONPATH, pour sa bonne execution...")
 		exit(1)
 
 
@@ -61,6 +68,299 @@ BSHELVES = {
 # pour trouver etc/dtdmashup et etc/pub2TEI installés avec ce fichier
 THIS_SCRIPT_DIR = path.dirname(path.realpath(__file__))
 
+# processus pour les transform_shelf (None: autant que de coeurs)
+TRANSFORM_WORKERS = None
+# fichiers envoyés d'un coup à chaque processus
+TRANSFORM_CHUNK = 64
+# conversions pub2tei en parallèle (None: autant que de coeurs)
+XSLT_WORKERS = None
+
+# splits a doctype declaration in 3 elements
+#  lhs + '"' + uri.dtd + '"' + rhs
+# (bytes: matched on the raw file header, cf. dtd_repair_file)
+DOCTYPE_DTD = rb'(<!DOCTYPE[^>]+(?:PUBLIC|SYSTEM)[^>]*)"([^"]+\.dtd)"((?:\[[^\]]*\])?[^>]*>)'
+# bytes read at the start of each file to find the DOCTYPE (the prolog)
+PROLOG_SIZE = 1 << 16
+
+
+class DownloadManifest(object):
+	"""
+	Persistent record of the files downloaded into a corpus
+	(usually meta/download_manifest.tsv)
+	
+	One line per recorded file, appended as soon as it arrived:
+	    basename.ext <TAB> status <TAB> size <TAB> sha1
+	with status 'ok' (file written) or 'absent' (API 404).
+	The last line for a file wins when the manifest is read again.
+	
+	=> allows interrupted downloads to resume: files already complete
+	   (same byte size, or same checksum if verify) are skipped
+	"""
+	def __init__(self, manifest_path, verify=False):
+		self.path = manifest_path
+		self.verify = verify
+		self.records = {}
+		self._lock = Lock()
+		
+		if path.exists(manifest_path):
+			mfh = open(manifest_path, 'r')
+			for line in mfh:
+				fields = line.rstrip('\n').split('\t')
+				# dernière ligne écrite éventuellement tronquée
+				if len(fields) != 4:
+					continue
+				fname, status, size, checksum = fields
+				self.records[fname] = {
+					'status': status,
+					'size'  : int(size) if size else None,
+					'sha1'  : checksum or None
+					}
+			mfh.close()
+	
+	def is_complete(self, file_path):
+		"""
+		True if the file was recorded and is still valid on disk
+		(or if it was recorded as absent from the API)
+		"""
+		rec = self.records.get(path.basename(file_path))
+		if rec is None:
+			return False
+		elif rec['status'] == 'absent':
+			return True
+		elif rec['status'] != 'ok':
+			return False
+		
+		# truncated or removed since ?
+		if (not path.exists(file_path)
+		    or path.getsize(file_path) != rec['size']):
+			return False
+		
+		if self.verify and rec['sha1']:
+			return file_sha1(file_path) == rec['sha1']
+		
+		return True
+	
+	def record(self, file_path, status, size=None, checksum=None):
+		"""
+		Appends a file status line (thread-safe)
+		"""
+		fname = path.basename(file_path)
+		with self._lock:
+			self.records[fname] = {'status':status, 'size':size, 'sha1':checksum}
+			mfh = open(self.path, 'a')
+			mfh.write("\t".join([fname, status,
+			                     '' if size is None else str(size),
+			                     checksum or '']) + "\n")
+			mfh.close()
+	
+	def update(self, file_path, size, checksum=None):
+		"""
+		New size and sha1 of a downloaded file that was transformed in
+		place (cf. Corpus.transform_shelf), so that it stays complete
+		"""
+		rec = self.records.get(path.basename(file_path))
+		if rec is not None and rec['status'] == 'ok':
+			self.record(file_path, 'ok', size, checksum)
+
+
+def file_sha1(file_path, chunk_size=1<<20):
+	"""
+	Hex sha1 of a file (read by chunks)
+	"""
+	hasher = sha1()
+	fh = open(file_path, 'rb')
+	for chunk in iter(lambda: fh.read(chunk_size), b''):
+		hasher.update(chunk)
+	fh.close()
+	return hasher.hexdigest()
+
+class TransformJournal(object):
+	"""
+	Persistent record of the files already processed by a shelf
+	transform (usually meta/<transform_name>.journal.tsv)
+	
+	One line per file, appended as soon as it was replaced:
+	    basename.ext <TAB> status <TAB> size <TAB> mtime_ns
+	with the size and mtime of the file just after the transform.
+	
+	=> an interrupted transform resumes with the files not yet recorded
+	   or that changed since (ex: downloaded again by a --resume)
+	   (the journal is removed when the whole shelf is done)
+	
+	Also used as a lasting per-doc report (closed instead of finished,
+	ex: meta/pub2tei_report.tsv with the stamps of the source files)
+	"""
+	def __init__(self, journal_path):
+		self.path = journal_path
+		self.statuses = {}
+		self.stamps = {}
+		
+		if path.exists(journal_path):
+			jfh = open(journal_path, 'r')
+			for line in jfh:
+				fields = line.rstrip('\n').split('\t')
+				# dernière ligne écrite éventuellement tronquée
+				if len(fields) != 4 or not line.endswith('\n'):
+					continue
+				fname, status, size, mtime = fields
+				self.statuses[fname] = status
+				self.stamps[fname] = (int(size), int(mtime)) if size else None
+			jfh.close()
+		
+		# line buffered: each record is on disk before the next file
+		self._jfh = open(journal_path, 'a', buffering=1)
+	
+	@staticmethod
+	def stamp(file_path):
+		"""(size, mtime_ns) of the file or None if it doesn't exist"""
+		try:
+			st = os.stat(file_path)
+		except FileNotFoundError:
+			return None
+		return (st.st_size, st.st_mtime_ns)
+	
+	def is_done(self, file_path):
+		fname = path.basename(file_path)
+		return (fname in self.statuses
+		        and self.stamps[fname] == self.stamp(file_path))
+	
+	def status(self, file_path):
+		return self.statuses.get(path.basename(file_path))
+	
+	def record(self, file_path, status):
+		fname = path.basename(file_path)
+		stamp = self.stamp(file_path)
+		self.statuses[fname] = status
+		self.stamps[fname] = stamp
+		size, mtime = stamp if stamp is not None else ('', '')
+		self._jfh.write("%s\t%s\t%s\t%s\n" % (fname, status, size, mtime))
+	
+	def close(self):
+		self._jfh.close()
+	
+	def finish(self):
+		"""Transform complete => journal no longer needed"""
+		self.close()
+		remove(self.path)
+
+
+def transform_file(file_fn, fi, fn_args=(), checksum=False):
+	"""
+	Runs file_fn(fi, tmp_path, *fn_args) => status
+	and if file_fn wrote tmp_path, atomically replaces fi by it
+	(worker of Corpus.transform_shelf)
+	
+	Returns (status, None) if fi didn't change
+	     or (status, (new_size, new_sha1 if checksum else None))
+	"""
+	tmp_path = path.join(path.dirname(fi), '.part-' + path.basename(fi))
+	new_file = None
+	try:
+		status = file_fn(fi, tmp_path, *fn_args)
+		if path.exists(tmp_path):
+			new_file = (path.getsize(tmp_path),
+			            file_sha1(tmp_path) if checksum else None)
+			replace(tmp_path, fi)
+	except BaseException:
+		if path.exists(tmp_path):
+			remove(tmp_path)
+		raise
+	return (status, new_file)
+
+
+def copy_tail(src_fh, dst_fh, offset):
+	"""
+	Appends the bytes of src_fh after *offset* to dst_fh, in the kernel
+	if possible (copy_file_range, or sendfile), else via copyfileobj
+	"""
+	dst_fh.flush()
+	src_fd = src_fh.fileno()
+	dst_fd = dst_fh.fileno()
+	n_left = fstat(src_fd).st_size - offset
+	
+	for kernel_copy in ('copy_file_range', 'sendfile'):
+		if not hasattr(os, kernel_copy):
+			continue
+		try:
+			while n_left > 0:
+				if kernel_copy == 'copy_file_range':
+					n = os.copy_file_range(src_fd, dst_fd, n_left, offset)
+				else:
+					n = os.sendfile(dst_fd, src_fd, offset, n_left)
+				if n == 0:
+					break
+				offset += n
+				n_left -= n
+			return
+		except OSError:
+			# ex: autre système de fichiers, noyau trop ancien
+			continue
+	
+	# fallback: copie python (là où la copie noyau s'est arrêtée)
+	src_fh.seek(offset)
+	dst_fh.seek(0, 2)
+	copyfileobj(src_fh, dst_fh)
+
+
+def dtd_repair_file(fi, tgt_path, dtd_prefix):
+	"""
+	Writes into tgt_path the native XML fi with its DTD uri replaced
+	by dtd_prefix + '/' + dtd_basename (cf. Corpus.dtd_repair)
+	
+	Only the prolog (the first PROLOG_SIZE bytes) is read and rewritten,
+	the rest of the file is copied as bytes (cf. copy_tail), and nothing
+	is written for a file without DTD or already pointing to the new DTD
+	path (the file stays as is).
+	
+	Returns a status: 'ok', 'missing', 'uerror' (file left as it is),
+	                  'no_dtd_wiley' or 'no_dtd_other' (left as is)
+	"""
+	try:
+		fh = open(fi, 'rb')
+	except FileNotFoundError as fnfe:
+		return 'missing'
+	
+	header = fh.read(PROLOG_SIZE)
+	try:
+		# (final=False: a char cut by PROLOG_SIZE isn't an error)
+		getincrementaldecoder('UTF-8')().decode(header, final=False)
+	except UnicodeDecodeError as ue:
+		fh.close()
+		# skipping reparation
+		return 'uerror'
+		# £TODO alternative: add to error/ignore list with the object
+	
+	m = search(DOCTYPE_DTD, header, MULTILINE)
+	
+	if not m:
+		fh.close()
+		if not search(rb'wiley', header):
+			# wiley often has no DTD declaration, just ns
+			return 'no_dtd_other'
+		else:
+			return 'no_dtd_wiley'
+	
+	# we replace the middle group uri with our prefix + old dtd_basename
+	dtd_uri = m.group(2).decode('UTF-8')
+	new_dtd_path = dtd_prefix + '/' + path.basename(dtd_uri)
+	
+	# already repaired (ex: 2nd run): no rewrite
+	if dtd_uri == new_dtd_path:
+		fh.close()
+		return 'ok'
+	
+	# splice at the match offsets + rest of the file as is
+	outfile = open(tgt_path, 'wb')
+	outfile.write(header[:m.start(2)])
+	outfile.write(new_dtd_path.encode('UTF-8'))
+	outfile.write(header[m.end(2):])
+	copy_tail(fh, outfile, len(header))
+	outfile.close()
+	fh.close()
+	
+	return 'ok'
+
+
 class Corpus(object):
 	"""
 	A collection of docs with their metadata
@@ -479,11 +779,82 @@ ERROR -- Corpus(__init__ from dir):
 	#
 	# (manipulate docs and create new dirs with the result)
 	
+	def transform_shelf(self, shelf, file_fn, fn_args=(), name=None,
+	                    workers=None, debug_lvl=0):
+		"""
+		Transforms in place each file of a shelf with
+		  file_fn(fileid, tmp_path, *fn_args) => status string
+		
+		file_fn writes the new contents to tmp_path (or nothing if the
+		file doesn't change) and tmp_path then atomically replaces the
+		file (cf. transform_file), on *workers* processes.
+		
+		Each replaced file is recorded in meta/<name>.journal.tsv, so an
+		interrupted transform can be called again: it resumes with the
+		files not yet recorded or modified since (file_fn must be
+		idempotent, as the last file replaced before a crash may not be
+		recorded).
+		
+		The new size and sha1 of the replaced files are also recorded in
+		meta/download_manifest.tsv if it exists (otherwise a --resume
+		would see them as truncated and download them again).
+		
+		Returns {fileid: status} for all the files of the shelf
+		"""
+		if not name:
+			name = file_fn.__name__
+		if not workers:
+			workers = TRANSFORM_WORKERS or cpu_count()
+		
+		journal = TransformJournal(path.join(self.cdir, 'meta',
+		                                     name+'.journal.tsv'))
+		
+		manifest_path = path.join(self.cdir, 'meta', 'download_manifest.tsv')
+		if path.exists(manifest_path):
+			manifest = DownloadManifest(manifest_path)
+		else:
+			manifest = None
+		
+		all_files = self.fileids(my_shelf=shelf)
+		todofiles = [fi for fi in all_files if not journal.is_done(fi)]
+		if len(todofiles) < len(all_files):
+			print("%s: resuming (%i files already done)"
+			       % (name.upper(), len(all_files) - len(todofiles)))
+		if debug_lvl >= 1:
+			print("%s: %i files on %i processes"
+			       % (name.upper(), len(todofiles), workers))
+		
+		try:
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				results = executor.map(transform_file,
+				                       repeat(file_fn),
+				                       todofiles,
+				                       repeat(fn_args),
+				                       repeat(manifest is not None),
+				                       chunksize=TRANSFORM_CHUNK)
+				for fi, (status, new_file) in zip(todofiles, results):
+					# manifest first: a file replaced but not journaled
+					# is just transformed again (idempotent file_fn)
+					if new_file and manifest is not None:
+						manifest.update(fi, *new_file)
+					journal.record(fi, status)
+		except BaseException:
+			journal.close()
+			raise
+		
+		all_statuses = {fi: journal.status(fi) for fi in all_files}
+		journal.finish()
+		
+		return all_statuses
+	
 	# GOLD NATIVE XML
-	def dtd_repair(self, dtd_prefix=None, our_home=None, debug_lvl=0):
+	def dtd_repair(self, dtd_prefix=None, our_home=None, debug_lvl=0, workers=None):
 		"""
 		Linking des dtd vers nos dtd stockées dans /etc
 		ou dans un éventuel autre dossier dtd_prefix
+		
+		(fichiers traités en parallèle par *workers* processus,
+		 et remplacés un à un: cf. transform_shelf)
 		"""
 		if not dtd_prefix:
 			dtd_prefix = path.abspath(path.join(THIS_SCRIPT_DIR,'etc','dtd_mashup'))
@@ -503,80 +874,26 @@ ERROR -- Corpus(__init__ from dir):
 			nb_no_dtd_wiley = 0
 			nb_no_dtd_other = 0
 			
-			# temporary repaired_dir
-			repaired_dir = path.join(self.cdir, 'data', 'with_dtd_repaired')
-			if path.exists(repaired_dir):
-				print ('DTD_REPAIR: overwriting previous aborted reparation')
-			else:
-				mkdir(repaired_dir)
+			# chaque fichier est remplacé en place (reprise possible)
+			statuses = self.transform_shelf("XMLN", dtd_repair_file,
+			                                fn_args=(dtd_prefix,),
+			                                name='dtd_repair',
+			                                workers=workers,
+			                                debug_lvl=debug_lvl)
 			
 			for fi in todofiles:
-				try:
-					fh = open(fi, 'r')
-				except FileNotFoundError as fnfe:
+				status = statuses[fi]
+				if status == 'missing':
 					nb_missing += 1
 					print("DTD_REPAIR (skip) missing source file %s" % fi)
-					continue
-				try:
-					long_str = fh.read()
-				except UnicodeDecodeError as ue:
+				elif status == 'uerror':
 					nb_uerrors += 1
 					print("DTD_REPAIR (skip) UTF-8 decode error in input file %s" % fi)
-					# moving the file as it is and skipping reparation
-					move(fi, path.join(repaired_dir,path.basename(fi)))
-					continue
-					# £TODO alternative: add to error/ignore list with the object
-				fh.close()
-				
-				# splits a doctype declaration in 3 elements
-				 # lhs + '"' + uri.dtd + '"' + rhs
-				m = search(
-				  r'(<!DOCTYPE[^>]+(?:PUBLIC|SYSTEM)[^>]*)"([^"]+\.dtd)"((?:\[[^\]]*\])?[^>]*>)',
-					long_str, 
-					MULTILINE
-					)
-				
-				if m:
-					# kept for later
-					left_hand_side = m.groups()[0]
-					right_hand_side = m.groups()[2]
-					
-					# we replace the middle group uri with our prefix + old dtd_basename
-					dtd_uri = m.groups()[1]
-					# print ('FOUND:' + dtd_uri)
-					dtd_basename = path.basename(dtd_uri)
-					new_dtd_path = dtd_prefix + '/' + dtd_basename
-					
-					# print(new_dtd_path)
-					
-					# substitute a posteriori
-					original_declaration = left_hand_side+'"'+dtd_uri+'"'+right_hand_side
-					new_declaration = left_hand_side+'"'+new_dtd_path+'"'+right_hand_side
-					new_str = sub(escape(original_declaration), new_declaration, long_str)
-					
-					# save
-					outfile = open(path.join(repaired_dir,path.basename(fi)), 'w')
-					outfile.write(new_str)
-					outfile.close()
-				else:
-					if not search(r'wiley', long_str):
-						# wiley often has no DTD declaration, just ns
-						nb_no_dtd_other += 1
-						print('DTD_REPAIR (skip) no match on %s' % fi)
-					else:
-						nb_no_dtd_wiley += 1
-					# save as is
-					filename = path.basename(fi)
-					outfile = open(path.join(repaired_dir,path.basename(fi)), 'w')
-					outfile.write(long_str)
-					outfile.close()
-			
-			# rename to std dir
-			orig_dir = self.shelf_path("XMLN")
-			if debug_lvl >= 2:
-				print ("DTD_REPAIR: replacing native XMLs in %s by temporary contents from %s" %(orig_dir, repaired_dir))
-			rmtree(orig_dir)
-			rename(repaired_dir, orig_dir)
+				elif status == 'no_dtd_other':
+					nb_no_dtd_other += 1
+					print('DTD_REPAIR (skip) no match on %s' % fi)
+				elif status == 'no_dtd_wiley':
+					nb_no_dtd_wiley += 1
 			
 			# report
 			print("----------")
@@ -590,13 +907,25 @@ ERROR -- Corpus(__init__ from dir):
 	
 	
 	# GOLDTEI
-	def pub2goldtei(self, pub2tei_dir=None, our_home=None, debug_lvl = 0):
+	def pub2goldtei(self, pub2tei_dir=None, our_home=None, debug_lvl = 0,
+	                workers=None, only_failed=False):
 		"""
 		Appel d'une transformation XSLT 2.0 Pub2TEI
 		
-		actuellement via appel système à saxonb-xslt
-		(renvoie 0 si tout est ok et 2 s'il n'y a eu ne serait-ce qu'une erreur)
+		via saxonche si installé, sinon via appel système à saxonb-xslt
+		(cf. xslt.get_backend), avec un succès ou un échec par document
+		
+		Les docs sont répartis en *workers* lots au plus, convertis en
+		parallèle (peu de docs => moins de lots, cf. xslt.MIN_SHARD_SIZE)
+		et le statut de chaque doc est ajouté à meta/pub2tei_report.tsv
+		(un TransformJournal : la dernière ligne d'un doc l'emporte)
+		
+		only_failed=True => ne reconvertit que les docs qui ne sont pas
+		                    'ok' dans ce rapport ou dont le XML natif a
+		                    changé depuis
 		"""
+		if not workers:
+			workers = XSLT_WORKERS or cpu_count()
 		
 		# dans 99% des cas c'est la même corpus_home
 		# que celle à l'initialisation de l'objet
@@ -631,42 +960,47 @@ ERROR -- Corpus(__init__ from dir):
 			if not path.exists(gtei_dirpath):
 				mkdir(gtei_dirpath)
 			
-			call_args = [
-			"saxonb-xslt", 
-			"-xsl:%s" % p2t_path,
-			"-s:%s" % xml_dirpath,
-			"-o:%s" % gtei_dirpath,
-			# notre param pour les gold
-			"teiBiblType=biblStruct",
-			# éviter les simples quotes dans l'arg
-			]
+			# statuts des conversions précédentes
+			# (rapport par doc pour relancer les échecs: only_failed)
+			report = TransformJournal(path.join(self.cdir, 'meta',
+			                                    'pub2tei_report.tsv'))
 			
-			if debug_lvl > 0:
-				print("XSL: (debug) appel=%s" % call_args)
+			# sorties directement en .tei.xml comme attendu par fileids()
+			pairs = list(zip(self.fileids("XMLN"), self.fileids("GTEI")))
+			if only_failed:
+				pairs = [(src_path, tgt_path) for src_path, tgt_path in pairs
+				           if not (report.is_done(src_path)
+				                   and report.status(src_path) == 'ok')]
+				print("XSL: %i docs to retry" % len(pairs))
 			
 			try:
-				# subprocess.call -----
-				retval= call(call_args)
+				# notre param pour les gold
+				results = xslt.transform_sharded(p2t_path,
+				                                 {'teiBiblType': 'biblStruct'},
+				                                 pairs,
+				                                 n_shards=workers,
+				                                 debug_lvl=debug_lvl)
 			except FileNotFoundError as fnfe:
-				if search(r"saxonb-xslt", fnfe.strerror):
-					print("XSL: les transformations pub2tei requièrent l'installation de saxonb-xslt (package libsaxonb-java)")
+				report.close()
+				if search(r"saxonb-xslt", str(fnfe)):
+					print("XSL: les transformations pub2tei requièrent l'installation de saxonb-xslt (package libsaxonb-java) ou de saxonche (pip)")
 					return None
 				else:
 					raise
 			
 			# verification si les docs sont bien passés
-			# et renommage en .tei.xml comme attendu par fileids()
-			for fid in self.bnames:
-				try:
-					rename(path.join(gtei_dirpath, fid+'.xml'),
-					        path.join(gtei_dirpath, fid+'.tei.xml'))
-				except FileNotFoundError as fnfe:
+			for src_path, tgt_path in pairs:
+				report.record(src_path, 'ok' if results[src_path] else 'failed')
+			report.close()
+			
+			for src_path in self.fileids("XMLN"):
+				if report.status(src_path) != 'ok':
 					# £TODO alternative: keeping an error/ignore list with the object
-					("XSL (skip) doc %s failed transformation" % fid)
+					print("XSL (skip) doc %s failed transformation" % path.basename(src_path))
 					nb_errors += 1
 			
 			# on ne renvoie pas de valeur de retour, on signale juste le succès ou non
-			if retval == 0:
+			if nb_errors == 0:
 				print("----------")
 				print("XSL: %i successful transformations (all)" % self.size)
 				print("----------")
@@ -707,7 +1041,8 @@ if __name__ == "__main__":
 """,
 		usage="""
 ------
-  corpusdirs.py un_nom_de_corpus --from mes_docs.tsv""",
+  corpusdirs.py un_nom_de_corpus --from mes_docs.tsv
+  corpusdirs.py un_nom_de_corpus --resume""",
 		epilog="""
 Actions:
 --------
@@ -734,7 +1069,24 @@ Actions:
 		help="""tableau en entrée (tout tsv avec en COL1 istex_id et en COL2 le nom du lot... (par ex: la sortie détaillée de l'échantilloneur sampler.py)""",
 		type=str,
 		default=None ,
-		required=True,
+		required=False,
+		action='store')
+	
+	parser.add_argument('--resume',
+		help="""reprendre un corpus déjà commencé dans ./un_nom_de_corpus (seuls les fichiers manquants ou tronqués d'après meta/download_manifest.tsv sont retéléchargés)""",
+		default=False,
+		action='store_true')
+	
+	parser.add_argument('--verify',
+		help="avec --resume: vérifier aussi les sommes sha1 des fichiers déjà là",
+		default=False,
+		action='store_true')
+	
+	parser.add_argument('-j', '--jobs',
+		metavar='4',
+		help="nombre de téléchargements en parallèle [default:4]",
+		type=int,
+		default=api.DOWNLOAD_WORKERS,
 		action='store')
 	
 	parser.add_argument('--debug',
@@ -751,45 +1103,63 @@ Actions:
 	corpus_name = args.un_nom_de_corpus
 	# =============================================
 	
-	if path.exists(corpus_name):
-		print("ERR: le nom '%s' est déjà pris dans ce dossier" % corpus_name)
-		exit(1)
-	
-	# (1/4) echantillon initial (juste la table) -------------------------
-	if path.exists(from_table):
-		fic = open(from_table)
-		my_tab = [l.rstrip() for l in fic.readlines()]
-		fic.close()
+	if args.resume:
+		if not path.exists(corpus_name):
+			print("ERR: pas de corpus '%s' à reprendre dans ce dossier" % corpus_name)
+			exit(1)
 	else:
-		print("ERR bako.make_set: je ne trouve pas la table '%s' pour initialiser le corpus" % from_table)
-		exit(1)
+		if path.exists(corpus_name):
+			print("ERR: le nom '%s' est déjà pris dans ce dossier (reprise possible avec --resume)" % corpus_name)
+			exit(1)
+		
+		# (1/4) echantillon initial (juste la table) ---------------------
+		if from_table and path.exists(from_table):
+			fic = open(from_table)
+			my_tab = [l.rstrip() for l in fic.readlines()]
+			fic.close()
+		else:
+			print("ERR bako.make_set: je ne trouve pas la table '%s' pour initialiser le corpus" % from_table)
+			exit(1)
 	
 	# (2/4) notre classe corpus ------------------------------------------
 	
 	# Corpus
-	# initialisation
-	#  - mode tab seul => fera un dossier meta/ et un data/ vide,
-	#  - le corpus_type est mis en dur à 'gold' ce qui signale
-	#    simplement qu'on ne change pas les étagères par défaut)
-	cobj = Corpus(corpus_name, new_infos = my_tab, new_home  = '.', verbose = (debug>0))
+	if args.resume:
+		# relecture du corpus (meta/infos.tab)
+		cobj = Corpus(corpus_name, read_dir = corpus_name, new_home = '.', verbose = (debug>0))
+	else:
+		# initialisation
+		#  - mode tab seul => fera un dossier meta/ et un data/ vide,
+		#  - le corpus_type est mis en dur à 'gold' ce qui signale
+		#    simplement qu'on ne change pas les étagères par défaut)
+		cobj = Corpus(corpus_name, new_infos = my_tab, new_home  = '.', verbose = (debug>0))
 	
 	# (3/4) téléchargement des fulltexts ---------------------------------
 	
 	my_ids = cobj.cols['istex_id']
 	my_basenames = cobj.bnames
 	
+	# suivi des fichiers arrivés (pour reprise éventuelle)
+	manifest = DownloadManifest(
+	             path.join(cobj.cdir, 'meta', 'download_manifest.tsv'),
+	             verify = args.verify
+	             )
+	
 	for the_shelf in ['PDF0', 'XMLN']:
 		the_api_type = cobj.origin(the_shelf)
 		the_ext      = cobj.filext(the_shelf)
 		tgt_dir      = cobj.shelf_path(the_shelf)
 		
-		print("mkdir -p: %s" % tgt_dir)
-		mkdir(tgt_dir)
+		if not path.exists(tgt_dir):
+			print("mkdir -p: %s" % tgt_dir)
+			mkdir(tgt_dir)
 		
 		api.write_fulltexts_loop_interact(
 			my_ids, my_basenames,
 			tgt_dir   = tgt_dir,
-			api_types = [the_api_type]
+			api_types = [the_api_type],
+			workers   = args.jobs,
+			manifest  = manifest
 			)
 		print("MAKE_SET: saved docs into CORPUS_HOME:%s" % cobj.name)
 		if debug > 0:
@@ -814,7 +1184,8 @@ Actions:
 	print("***XML => TEI.XML CONVERSION***")
 	
 	# créera le dossier C-goldxmltei
-	cobj.pub2goldtei(debug_lvl = debug)      # conversion
+	# (avec --resume: seulement les docs pas encore convertis)
+	cobj.pub2goldtei(debug_lvl = debug, only_failed = args.resume)      # conversion
 	
 	cobj.assert_docs('GTEI')
 	
@@ -32,13 +32,19 @@ __status__    = "Dev"
 
 # imports standard
 from sys       import argv, stderr
-from re        import sub, search, escape
-from random    import shuffle
+from re        import sub, search, escape, split
+from random    import sample as random_sample
+from collections import defaultdict
+from bisect    import bisect_left
+from mmap      import mmap, ACCESS_READ
 from itertools import product
 from datetime  import datetime
-from os        import path, mkdir, getcwd
-from json      import dump, load
+from time      import time
+from os        import path, mkdir, makedirs, getcwd, getpid, listdir, remove, replace
+from hashlib   import md5
+from json      import dump, load, dumps, loads
 from argparse  import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 
 
 # imports locaux
@@ -71,8 +77,26 @@ HOME=path.dirname(path.realpath(__file__))
 MAX_RUNS = 5
 # paramètre de lissage +k à chaque quota (aka lissage de Laplace)
 LISSAGE = 0.2
-# list of IDs to exclude from the sample result
-FORBIDDEN_IDS = []
+# set of IDs to exclude from the sample result (cf. load_exclusion_list)
+FORBIDDEN_IDS = set()
+# exclusion lists bigger than this (in bytes) are memory-mapped (cf. IdStore)
+EXCLUDE_MMAP_MIN_BYTES = 20 * 1024 * 1024
+# number of ids per enrich_index query
+# (a 40 chars id + ' OR ' ~ 50 url chars => URLs under 8k)
+ID_BATCH_SIZE = 150
+# seed for a random ranking of the quota hits (None: relevance ranking)
+RANDOM_SEED = None
+# number of parallel count queries for the pools
+POOL_WORKERS = 8
+# max API requests per second (shared by all workers)
+MAX_RATE = 20
+# checkpoints of the current run (cf. SampleJournal)
+JOURNAL = None
+STATE_FILE = 'sampler_state.jsonl'
+# optional update of cached pools: None, 'stale' or 'changed'
+POOL_REFRESH = None
+# age in seconds after which a cached pool count is stale
+POOL_MAX_AGE = 30 * 86400
 
 
 # fields allowed as criteria
@@ -98,6 +122,25 @@ RANGEFACET_FIELDS = [
 	'copyrightDate'
 	]
 
+# allowed chars in ISTEX IDs
+HEX_CHARS = '0123456789ABCDEF'
+
+# values that are just a term (can be matched with a terms facet key)
+# (as opposed to ranges or lucene expressions)
+PLAIN_VALUE = r'^[\w.-]+$'
+
+# max number of buckets in a terms facet from the API
+# (beyond: truncated list)
+FACET_TRUNCATION = 10
+
+# fields where a doc can have several values
+# (their pool counts can't be summed to get a marginal distribution)
+MULTIVALUED_FIELDS = [
+	'language',
+	'genre',
+	'categories.wos'
+	]
+
 # ----------------------------------------------------------------------
 # CONSTANT mapping standard fields
 # (key: API Name, val: local name <= the value is actually not used
@@ -142,9 +185,9 @@ def my_parse_args(arglist=None):
 	------------------------------------------------------------""",
 		usage="\n------\n  sampler.py -n 10000 [--with 'lucene query'] [--crit luceneField1 luceneField2 ...]",
 		epilog="""--------------
-/!\\ known bug: until API provides random ranking function, we are going
-               to create *identical* samples for 2 runs with same params
-               (instead of creating 2 different random ones...)
+/!\\ NB: without --random-seed, 2 runs with same params create
+        *identical* samples (the API ranks the hits by relevance)
+        => use 2 different seeds to get 2 different random samples
 
 © 2014-2015 :: romain.loth at inist.fr :: Inist-CNRS (ISTEX)
 """
@@ -222,6 +265,81 @@ def my_parse_args(arglist=None):
 		action='store')
 	
 	
+	parser.add_argument('-r', '--random-seed',
+		dest="random_seed",
+		metavar='42',
+		help="""
+		random ranking of the hits for each quota (API rankBy=random)
+		(same seed => same sample) (default: relevance ranking)""",
+		type=int,
+		required=False,
+		action='store')
+	
+	parser.add_argument('-j', '--jobs',
+		dest="pool_workers",
+		metavar='8',
+		help="number of parallel API requests (pool counts, downloads) (default: 8)",
+		type=int,
+		default=POOL_WORKERS,
+		required=False,
+		action='store')
+	
+	parser.add_argument('--max-rate',
+		dest="max_rate",
+		metavar='20',
+		help="max API requests per second (default: 20)",
+		type=float,
+		default=MAX_RATE,
+		required=False,
+		action='store')
+	
+	parser.add_argument('--refresh-pools',
+		dest="refresh_pools",
+		metavar="stale",
+		help="""
+		recount some of the cached pools:
+		  stale:   those counted more than --max-age days ago
+		  changed: those whose corpus changed since their count""",
+		choices=['stale', 'changed'],
+		type=str,
+		default=None,
+		required=False,
+		action='store')
+	
+	parser.add_argument('--max-age',
+		dest="max_age",
+		metavar='30',
+		help="age in days of stale pool counts (default: 30)",
+		type=float,
+		default=POOL_MAX_AGE / 86400,
+		required=False,
+		action='store')
+	
+	parser.add_argument('--no-cache',
+		dest="no_cache",
+		help="always ask the API (bypass the local cache of its responses)",
+		default=False,
+		required=False,
+		action='store_true')
+	
+	parser.add_argument('--resume',
+		dest="resume",
+		help="""
+		continue an interrupted run from its state file
+		(same other args as the interrupted run)""",
+		default=False,
+		required=False,
+		action='store_true')
+	
+	parser.add_argument('--state-file',
+		dest="state_file",
+		metavar=STATE_FILE,
+		help="checkpoints of the run, removed at the end (default: ./%s)" % STATE_FILE,
+		type=str,
+		default=STATE_FILE,
+		required=False,
+		action='store')
+	
 	parser.add_argument('-v', '--verbose',
 		help="verbose switch",
 		default=False,
@@ -245,14 +363,7 @@ def my_parse_args(arglist=None):
 
 	# do we need to forbid an ID list ?
 	if args.exclude_list_path:
-		fh = open(args.exclude_list_path, 'r')
-		i = 0
-		for line in fh:
-			i += 1
-			if search("^[0-9A-F]{40}$", line):
-				FORBIDDEN_IDS.append(line.rstrip())
-			else:
-				raise TypeError("line %i is not a valid ISTEX ID" % i)
+		FORBIDDEN_IDS = load_exclusion_list(args.exclude_list_path)
 	
 	
 	if not flag_ok:
@@ -262,6 +373,116 @@ def my_parse_args(arglist=None):
 	return(args)
 
 
+def read_id_list(list_path):
+	"""
+	Generator over the ISTEX IDs of a file (1 ID per line)
+	"""
+	fh = open(list_path, 'r')
+	for i, line in enumerate(fh):
+		idi = line.rstrip()
+		# 40 chars [0-9A-F] (str.strip is much faster than a regex)
+		if len(idi) != 40 or idi.strip(HEX_CHARS):
+			fh.close()
+			raise TypeError("line %i is not a valid ISTEX ID" % (i+1))
+		yield idi
+	fh.close()
+
+
+def load_exclusion_list(list_path):
+	"""
+	IDs to exclude from the sample: a set, or for very big lists
+	an IdStore (sorted binary IDs on disk, same 'in' and 'len' usage)
+	"""
+	if path.getsize(list_path) > EXCLUDE_MMAP_MIN_BYTES:
+		return IdStore(list_path)
+	else:
+		return set(read_id_list(list_path))
+
+
+class IdStore(object):
+	"""
+	Read-only set of ISTEX IDs for very big exclusion lists
+	
+	The IDs are stored as sorted 20-byte binary strings in a file next
+	to the list (list_path + '.ids.bin', rebuilt if the list is newer)
+	which is memory-mapped: lookups are binary searches and the memory
+	used stays under what the OS keeps in its page cache.
+	
+	If the list's dir is read-only, the file goes to the user cache dir
+	(next to api.CACHE_PATH) and if that fails too the binary IDs are
+	just kept in memory.
+	"""
+	def __init__(self, list_path):
+		cache_name = md5(path.abspath(list_path).encode()).hexdigest() + '.ids.bin'
+		candidates = [list_path + '.ids.bin',
+		              path.join(path.dirname(api.CACHE_PATH), cache_name)]
+		
+		binary_ids = None
+		bin_path = None
+		for candidate in candidates:
+			if IdStore.sidecar_ok(candidate, list_path):
+				bin_path = candidate
+				break
+			
+			if binary_ids is None:
+				binary_ids = b''.join(sorted(set(bytes.fromhex(idi)
+				                      for idi in read_id_list(list_path))))
+			
+			# écriture atomique (pas de sidecar tronqué si interrompu)
+			tmp_path = candidate + '.%i.tmp' % getpid()
+			try:
+				makedirs(path.dirname(path.abspath(candidate)), exist_ok=True)
+				bfh = open(tmp_path, 'wb')
+				bfh.write(binary_ids)
+				bfh.close()
+				replace(tmp_path, candidate)
+				bin_path = candidate
+				break
+			except OSError as os_e:
+				print("WARN: can't write %s (%s)" % (candidate, os_e), file=stderr)
+				if path.exists(tmp_path):
+					remove(tmp_path)
+		
+		self.path = bin_path
+		if bin_path is None:
+			print("WARN: keeping the %s IDs in memory" % list_path, file=stderr)
+			self._mm = binary_ids
+			self._n = len(binary_ids) // 20
+			return
+		
+		self._n = path.getsize(bin_path) // 20
+		if self._n:
+			bfh = open(bin_path, 'rb')
+			self._mm = mmap(bfh.fileno(), 0, access=ACCESS_READ)
+			bfh.close()
+		else:
+			self._mm = b''
+	
+	@staticmethod
+	def sidecar_ok(bin_path, list_path):
+		"""
+		An existing sidecar is reused if it's newer than the list and
+		made of whole 20-byte IDs
+		"""
+		return (path.exists(bin_path)
+		        and path.getmtime(bin_path) >= path.getmtime(list_path)
+		        and path.getsize(bin_path) % 20 == 0)
+	
+	def __len__(self):
+		return self._n
+	
+	def __getitem__(self, i):
+		return self._mm[20*i:20*(i+1)]
+	
+	def __contains__(self, idi):
+		try:
+			key = bytes.fromhex(idi)
+		except ValueError:
+			return False
+		i = bisect_left(self, key)
+		return i < self._n and self[i] == key
+
+
 def facet_vals(field_name):
 	"""
 	For each field, returns the list of possible outcomes
@@ -362,128 +583,43 @@ def sample(size, crit_fields, constraint_query=None, index=None,
 	
 	# allows to set default to None instead of tricky-scope mutable {}
 	if not index:
-		index = {}
+		index = SampleIndex()
 		flag_previous_index = False
 	else:
+		if not isinstance(index, SampleIndex):
+			index = SampleIndex(index)
 		flag_previous_index = True
 	
 	
 	####### POOLING ########
 	#
-	N_reponses = 0
-	N_workdocs = 0
-	doc_grand_total = 0
 	# dict of counts for each combo ((crit1:val_1a),(crit2:val_2a)...)
-	abs_freqs = {}
-	
-	
-	# instead do steps (1) (2) maybe we have cached the pools ?
-	# (always same counts for given criteria) => cache to json
-	cache_filename = pool_cache_path(crit_fields)
-	print('...checking cache for %s' % cache_filename,file=stderr)
-	
-	if path.exists(cache_filename):
-		cache = open(cache_filename, 'r')
-		pool_info = load(cache)
-		abs_freqs       = pool_info['f']
-		N_reponses      = pool_info['nr']
-		N_workdocs      = pool_info['nd']
-		doc_grand_total = pool_info['totd']
-		print('...ok cache (%i workdocs)' % N_workdocs,file=stderr)
-	else:
-		print('...no cache found',file=stderr)
-		
-		# (1) PARTITIONING THE SEARCH SPACE IN POSSIBLE OUTCOMES --------
-		print("Sending count queries for criteria pools...",file=stderr)
-		## build all "field:values" pairs per criterion field
-		## (list of list of strings: future lucene query chunks)
-		all_possibilities = []
-		n_combos = 1
-		for my_criterion in crit_fields:
-			field_outcomes = facet_vals(my_criterion)
-			n_combos = n_combos * len(field_outcomes)
-			# lucene query chunks
-			all_possibilities.append(
-				[my_criterion + ':' + val for val in field_outcomes]
-			)
-		
-		
-		## list combos (cartesian product of field_outcomes)
-		# we're directly unpacking *args into itertool.product()
-		# (=> we get an iterator over tuples of combinable query chunks)
-		combinations = product(*all_possibilities)
-		
-		
-		# example for -c corpusName, publicationDate
-		#	[
-		#	('corpusName:ecco', 'publicationDate:[* TO 1959]'),
-		#	('corpusName:ecco', 'publicationDate:[1960 TO 1999]'),
-		#	('corpusName:ecco', 'publicationDate:[2000 TO *]'),
-		#	('corpusName:elsevier', 'publicationDate:[* TO 1959]'),
-		#	('corpusName:elsevier', 'publicationDate:[1960 TO 1999]'),
-		#	('corpusName:elsevier', 'publicationDate:[2000 TO *]'),
-		#	(...)
-		#	]
-		
-		# (2) getting total counts for each criteria --------------------
-		
-		# number of counted answers
-		#  (1 doc can give several hits if a criterion was multivalued)
-		N_reponses = 0
-		
-		# do the counting for each combo
-		for i, combi in enumerate(sorted(combinations)):
-			if i % 100 == 0:
-				print("pool %i/%i" % (i,n_combos), file=stderr)
-			
-			query = " AND ".join(combi)
-			
-			# counting requests ++++
-			freq = api.count(query)
-			
-			if verbose:
-				print("pool:'% -30s': % 8i" %(query,freq),file=stderr)
-			
-			# storing and agregation
-			N_reponses += freq
-			abs_freqs[query] = freq
-		
-		# number of documents sending answers (hence normalizing constant N)
-		N_workdocs = api.count(" AND ".join([k+":*" for k in crit_fields]))
-		
-		if verbose:
-			print("--------- pool totals -----------", file=stderr)
-			print("#answered hits :   % 12s" % N_reponses, file=stderr)
-			print("#workdocs (N) :    % 12s" % N_workdocs, file=stderr)
-			# for comparison: all_docs = N + api.count(q="NOT(criterion:*)")
-			doc_grand_total = api.count(q='*')
-			print("#all API docs fyi: % 12s" % doc_grand_total,file=stderr)
-			print("---------------------------------", file=stderr)
-		
-		
-		# cache write
-		cache = open(cache_filename, 'w')
-		pool_info = {'f':abs_freqs, 'nr':N_reponses, 
-		            'nd':N_workdocs, 'totd':doc_grand_total}
-		# json.dump
-		dump(pool_info, cache, indent=1)
-		cache.close()
+	# + pool totals (from cache if possible, cf. get_pools)
+	pool_info = get_pools(crit_fields, verbose=verbose)
+	abs_freqs       = pool_info['f']
+	N_reponses      = pool_info['nr']
+	N_workdocs      = pool_info['nd']
+	doc_grand_total = pool_info['totd']
 	
 	
 	######### QUOTA ########
 	#
 	# (3) quota computation and availability checking ------------------
-	# quota computation
-	rel_freqs = {}
-	for combi_query in abs_freqs:
-		
-		# expérimenter avec N_reponses au dénominateur ?
-		quota = round(
-		  size * abs_freqs[combi_query] / N_workdocs + LISSAGE
-		)
-		
-		if quota != 0:
-			rel_freqs[combi_query] = quota
+	# docs from previous runs per combo of the current criteria
+	retrieved_by_combo = index.counts_by_combo(crit_fields)
+	
+	# quota computation: exactly size docs (largest remainders), but
+	# never more than the docs of the pool that we don't have yet
+	# (keys in canonical order: the cached combos may come from a run
+	#  with the same criteria in another order)
+	combo_keys = {combi_query: combo_key(combi_query, crit_fields)
+	                  for combi_query in abs_freqs}
+	caps = {combi_query: max(0, n - retrieved_by_combo[combo_keys[combi_query]])
+	            for combi_query, n in abs_freqs.items()}
+	quotas = allocate_quotas(size, abs_freqs, N_workdocs,
+	                         smoothing=LISSAGE, caps=caps)
+	rel_freqs = {combi_query: quota for combi_query, quota in quotas.items()
+	                                if quota != 0}
 	
 	# fyi 3 lines to check if rounding surprise
 	rndd_size = sum([quota for combi_query, quota in rel_freqs.items()])
@@ -498,6 +634,16 @@ def sample(size, crit_fields, constraint_query=None, index=None,
 	
 	print("Retrieving new sample chunks per pool quota...", file=stderr)
 	
+	# number of this sample() call for the checkpoints
+	if JOURNAL is not None:
+		run_no = JOURNAL.new_run()
+	
+	# random ranking: a new order at each run (but reproducible)
+	if RANDOM_SEED is not None:
+		run_seed = RANDOM_SEED + len(index)
+	else:
+		run_seed = None
+	
 	for combi_query in sorted(rel_freqs.keys()):
 		
 		# how many hits do we need?
@@ -505,6 +651,15 @@ def sample(size, crit_fields, constraint_query=None, index=None,
 		if not flag_previous_index and not FORBIDDEN_IDS:
 			# option A: direct quota allocation to search limit
 			n_needed = my_quota
+		elif RANDOM_SEED is not None:
+			# option C: random ranking, with another seed for each
+			#           rerun => the already retrieved are spread in the
+			#           new order instead of coming first, but they are
+			#           still drawn (retrieved/pool of the hits): same
+			#           margin as option B (+ the forbidden ids prorata)
+			n_needed = (my_quota
+			            + retrieved_by_combo[combo_keys[combi_query]]
+			            + round(len(FORBIDDEN_IDS) * my_quota / size))
 		else:
 			# option B: limit larger than quota by retrieved amount
 			#           (provides deduplication margin if 2nd run)
@@ -513,11 +668,7 @@ def sample(size, crit_fields, constraint_query=None, index=None,
 			#     duplicates, like with random result ranking)
 			
 			# supplément 1: items to skip
-			n_already_retrieved = len(
-				# lookup retrieved
-				[idi for idi,metad in index.items()
-					if search(escape(combi_query), metad['_q'])]
-				)
+			n_already_retrieved = retrieved_by_combo[combo_keys[combi_query]]
 			
 			# supplément 2: prorata de FORBIDDEN_IDS
 			suppl = round(len(FORBIDDEN_IDS) * my_quota / size)
@@ -530,93 +681,55 @@ def sample(size, crit_fields, constraint_query=None, index=None,
 		else:
 			my_query = combi_query
 		
-		# ----------------- api.search(...) ----------------------------
-		json_hits = api.search(my_query, 
-		                       limit=n_needed,
-		                       outfields=STD_MAP.keys())
-	        # outfields=('id','author.name','title','publicationDate','corpusName')
-
-		# --------------------------------------------------------------
-		
-		# NB: 'id' field would be enough for sampling itself, but we get
-		#     more metadatas to be able to provide an info table or to
-		#     create a human-readable filename
-		
-		# £TODO 1
-		# remplacer api.search() par une future fonction random_search
-		# cf. elasticsearch guide: "random scoring" (=> puis supprimer
-		# l'option B avec n_needed)
-		
-		my_n_answers = len(json_hits)
-		
-		my_n_got = 0
+		# combo already done before an interruption ? (cf. SampleJournal)
+		done = JOURNAL.done(run_no, combi_query) if JOURNAL else None
 		
-		# for debug
-		# print("HITS:",json_hits, file=stderr)
+		if done is not None:
+			# replay
+			my_n_answers, new_ids = done
+			for idi in new_ids:
+				index[idi] = {'_q': combi_query}
 		
-		
-		# check unicity
-		for hit in json_hits:
-			idi = hit['id']
+		else:
+			# ----------------- api.search(...) ------------------------
+			json_hits = api.search(my_query, 
+			                       limit=n_needed,
+			                       outfields=['id'],
+			                       random_seed=run_seed)
+			# ----------------------------------------------------------
 			
-			if idi not in index and idi not in FORBIDDEN_IDS:
-				# print(hit)
-				# exit()
-				my_n_got += 1
-				# main index
-				index[idi] = {
-					'_q': combi_query,
-					'co': hit['corpusName'][0:3]  # trigramme eg 'els'
-					}
-				# store info
-				# £TODO: check conventions for null values
-				# £TODO: ajouter tout ça dans STD_MAP
-				if 'publicationDate' in hit and len(hit['publicationDate']):
-					index[idi]['yr'] = hit['publicationDate'][0:4]
-				else:
-					index[idi]['yr'] = 'XXXX'
-				
-				if 'title' in hit and len(hit['title']):
-					index[idi]['ti'] = hit['title']
-				else:
-					index[idi]['ti'] = "UNTITLED"
-				
-				if 'author' in hit and len(hit['author'][0]['name']):
-					first_auth = hit['author'][0]['name']
-					his_lastname = first_auth.split()[-1]
-					index[idi]['au'] = his_lastname
-				else:
-					index[idi]['au'] = "UNKNOWN"
-				
-				if 'language' in hit and len(hit['language']):
-					index[idi]['lg'] = hit['language'][0]
-				else:
-					index[idi]['lg'] = "UNKOWN_LANG"
-				
-				if 'genre' in hit and len(hit['genre']):
-					index[idi]['typ'] = hit['genre'][0]
-				else:
-					index[idi]['typ'] = "UNKOWN_GENRE"
-				
-				if 'categories' in hit and len(hit['categories']) and 'wos' in hit['categories'] and len(hit['categories']['wos']):
-					index[idi]['cat'] = "/".join(hit['categories']['wos'])
-				else:
-					index[idi]['cat'] = "UNKOWN_SCI_CAT"
-				
-				if 'qualityIndicators' in hit and 'pdfVersion' in hit['qualityIndicators']:
-					index[idi]['ver'] = hit['qualityIndicators']['pdfVersion']
-				else:
-					index[idi]['ver'] = "UNKNOWN_PDFVER"
+			# NB: 'id' field is enough for sampling itself, the metadatas
+			#     for the info table or the human-readable filenames are
+			#     retrieved afterwards for the final sample only
+			#     (cf. enrich_index)
+			
+			my_n_answers = len(json_hits)
+			
+			new_ids = []
+			
+			# for debug
+			# print("HITS:",json_hits, file=stderr)
+			
+			
+			# check unicity
+			for hit in json_hits:
+				idi = hit['id']
 				
-				if 'qualityIndicators' in hit and 'pdfWordCount' in hit['qualityIndicators']:
-					index[idi]['wcp'] = hit['qualityIndicators']['pdfWordCount']
-				else:
-					index[idi]['wcp'] = "UNKNOWN_PDFWORDCOUNT"
+				if idi not in index and idi not in FORBIDDEN_IDS:
+					new_ids.append(idi)
+					# main index
+					index[idi] = {'_q': combi_query}
 				
-			# recheck limit: needed as long as n_needed != my_quota 
-			# (should disappear as consequence of removing option B)
-			if my_n_got == my_quota:
-				break
+				# recheck limit: needed as long as n_needed != my_quota 
+				# (should disappear as consequence of removing option B)
+				if len(new_ids) == my_quota:
+					break
+			
+			# checkpoint
+			if JOURNAL is not None:
+				JOURNAL.record(run_no, combi_query, my_n_answers, new_ids)
+		
+		my_n_got = len(new_ids)
 		
 		print ("%-70s: %i(%i)/%i" % (
 					my_query[0:67]+"...", 
@@ -637,6 +750,860 @@ def sample(size, crit_fields, constraint_query=None, index=None,
 	return(index)
 
 
+def hit_info(hit):
+	"""
+	Short infos from an API hit with the STD_MAP fields
+	(for the 'tab' output and std_filename)
+	"""
+	info = {}
+	# £TODO: check conventions for null values
+	# £TODO: ajouter tout ça dans STD_MAP
+	if 'corpusName' in hit and len(hit['corpusName']):
+		info['co'] = hit['corpusName'][0:3]  # trigramme eg 'els'
+	else:
+		info['co'] = "UNK"
+	
+	if 'publicationDate' in hit and len(hit['publicationDate']):
+		info['yr'] = hit['publicationDate'][0:4]
+	else:
+		info['yr'] = 'XXXX'
+	
+	if 'title' in hit and len(hit['title']):
+		info['ti'] = hit['title']
+	else:
+		info['ti'] = "UNTITLED"
+	
+	if 'author' in hit and len(hit['author'][0]['name']):
+		first_auth = hit['author'][0]['name']
+		his_lastname = first_auth.split()[-1]
+		info['au'] = his_lastname
+	else:
+		info['au'] = "UNKNOWN"
+	
+	if 'language' in hit and len(hit['language']):
+		info['lg'] = hit['language'][0]
+	else:
+		info['lg'] = "UNKOWN_LANG"
+	
+	if 'genre' in hit and len(hit['genre']):
+		info['typ'] = hit['genre'][0]
+	else:
+		info['typ'] = "UNKOWN_GENRE"
+	
+	if 'categories' in hit and len(hit['categories']) and 'wos' in hit['categories'] and len(hit['categories']['wos']):
+		info['cat'] = "/".join(hit['categories']['wos'])
+	else:
+		info['cat'] = "UNKOWN_SCI_CAT"
+	
+	if 'qualityIndicators' in hit and 'pdfVersion' in hit['qualityIndicators']:
+		info['ver'] = hit['qualityIndicators']['pdfVersion']
+	else:
+		info['ver'] = "UNKNOWN_PDFVER"
+	
+	if 'qualityIndicators' in hit and 'pdfWordCount' in hit['qualityIndicators']:
+		info['wcp'] = hit['qualityIndicators']['pdfWordCount']
+	else:
+		info['wcp'] = "UNKNOWN_PDFWORDCOUNT"
+	
+	return info
+
+
+def enrich_index(index, batch_size=None, workers=None, verbose=False):
+	"""
+	Adds the STD_MAP infos to each doc of the index (in place)
+	with batched id:(A OR B OR ...) queries
+	
+	=> called on the final sample only, so the metadatas of the docs
+	   dropped by XDEL are never downloaded
+	"""
+	if not batch_size:
+		batch_size = ID_BATCH_SIZE
+	if not workers:
+		workers = POOL_WORKERS
+	
+	ids = [idi for idi in index if 'co' not in index[idi]]
+	batches = [ids[i:i+batch_size] for i in range(0, len(ids), batch_size)]
+	
+	def search_batch(batch):
+		# 1 requête par lot (pas de décompte préalable comme dans api.search)
+		my_url = api.search_url('id:(' + ' OR '.join(batch) + ')',
+		                        outfields=STD_MAP.keys(),
+		                        size=len(batch))
+		return api._get(my_url)['hits']
+	
+	n_batches = len(batches)
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for i, json_hits in enumerate(executor.map(search_batch, batches)):
+			if verbose:
+				print("enrich batch %i/%i" % (i+1,n_batches), file=stderr)
+			for hit in json_hits:
+				if hit['id'] in index:
+					index[hit['id']].update(hit_info(hit))
+	
+	# ids not found (shouldn't happen): default values
+	for idi in ids:
+		if 'co' not in index[idi]:
+			index[idi].update(hit_info({}))
+	
+	return index
+
+
+def allocate_quotas(size, freqs, n_docs=None, smoothing=0, caps=None):
+	"""
+	Splits a sample *size* among the pools {combo: count} proportionally
+	to their counts + a *smoothing* bonus (share of size*f/n_docs + k)
+	
+	Largest remainder method (Hamilton): the shares are floored and the
+	docs left are given to the largest fractional parts, so the quotas
+	sum exactly to size (instead of drifting with each rounding).
+	
+	With *caps* {combo: max docs available}, a pool whose share exceeds
+	its cap gets its cap and the rest goes to the other pools
+	(total < size only if all pools are capped).
+	
+	Returns {combo: int quota}
+	"""
+	if n_docs is None:
+		n_docs = sum(freqs.values())
+	if caps is None:
+		caps = {}
+	
+	# sorted for reproducible tie-breaks
+	combos = sorted(freqs)
+	quotas = dict.fromkeys(combos, 0)
+	if not combos or not n_docs or size <= 0:
+		return quotas
+	
+	weights = {c: freqs[c] / n_docs + smoothing / size for c in combos}
+	cap = {c: caps.get(c, float('inf')) for c in combos}
+	
+	# exact shares, with the capped pools fixed at their cap
+	# (each pass fixes at least 1 pool => at most len(combos) passes)
+	shares = {}
+	free = [c for c in combos if cap[c] > 0]
+	to_share = size
+	while free:
+		total_w = sum(weights[c] for c in free)
+		if total_w <= 0:
+			break
+		over = [c for c in free if to_share * weights[c] / total_w >= cap[c]]
+		if not over:
+			for c in free:
+				shares[c] = to_share * weights[c] / total_w
+			break
+		for c in over:
+			shares[c] = cap[c]
+			to_share -= cap[c]
+		free = [c for c in free if c not in shares]
+	
+	# floors then +1 for the largest remainders
+	for c, share in shares.items():
+		quotas[c] = int(share)
+	n_left = min(size, sum(shares.values())) - sum(quotas.values())
+	by_remainder = sorted(shares, key=lambda c: quotas[c] - shares[c])
+	for c in by_remainder[0:max(0, round(n_left))]:
+		quotas[c] += 1
+	
+	return quotas
+
+
+class SampleJournal(object):
+	"""
+	Append-only checkpoints of a sampler run (1 json per line)
+	
+	    {"params": {...}}                              (1st line)
+	    {"run": 0, "q": combo, "na": n_answers, "ids": [new ids...]}
+	    ...
+	    {"xdel": [ids removed by the final random pruning]}
+	
+	A line is written as soon as a combo query is done. Resuming replays
+	full_run with the same params: each sample() call gets the same run
+	number as before, its recorded combos are taken from the journal
+	instead of the API and only the missing ones are queried.
+	
+	The file is removed once the sample is complete (cf. finish).
+	"""
+	def __init__(self, state_path, params, resume=False):
+		self.path = state_path
+		self.params = params
+		self.runs = 0
+		self.combos = {}
+		self.xdel = None
+		
+		if resume and path.exists(state_path):
+			sfh = open(state_path, 'r')
+			for i, line in enumerate(sfh):
+				try:
+					rec = loads(line)
+				except ValueError:
+					# dernière ligne écrite éventuellement tronquée
+					continue
+				if 'params' in rec:
+					if rec['params'] != params:
+						sfh.close()
+						raise ValueError("the state file %s was written with other params: %s" % (state_path, rec['params']))
+				elif 'xdel' in rec:
+					self.xdel = rec['xdel']
+				else:
+					self.combos[(rec['run'], rec['q'])] = (rec['na'], rec['ids'])
+			sfh.close()
+			print("Resuming from %s (%i combos done)" %
+			      (state_path, len(self.combos)), file=stderr)
+		else:
+			# nouveau départ
+			self._append({'params': params}, mode='w')
+	
+	def _append(self, rec, mode='a'):
+		sfh = open(self.path, mode)
+		sfh.write(dumps(rec) + "\n")
+		sfh.close()
+	
+	def new_run(self):
+		"""Number of the next sample() call"""
+		self.runs += 1
+		return self.runs - 1
+	
+	def done(self, run_no, combi_query):
+		"""(n_answers, new_ids) if the combo was recorded, else None"""
+		return self.combos.get((run_no, combi_query))
+	
+	def record(self, run_no, combi_query, n_answers, new_ids):
+		self.combos[(run_no, combi_query)] = (n_answers, new_ids)
+		self._append({'run': run_no, 'q': combi_query,
+		              'na': n_answers, 'ids': new_ids})
+	
+	def record_xdel(self, removed_ids):
+		self.xdel = removed_ids
+		self._append({'xdel': removed_ids})
+	
+	def finish(self):
+		"""Sample complete => checkpoints no longer needed"""
+		if path.exists(self.path):
+			remove(self.path)
+
+
+class SampleIndex(dict):
+	"""
+	The sample index {istex_id: infos} (where infos always has a '_q')
+	with a reverse index of the ids per '_q' combo, kept in sync when
+	docs are added or removed
+	
+	=> the number of docs already retrieved for a combo is a lookup
+	   instead of a scan of the whole index
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__()
+		# '_q' => set of ids
+		self.by_q = defaultdict(set)
+		for idi, infos in dict(*args, **kwargs).items():
+			self[idi] = infos
+	
+	def __setitem__(self, idi, infos):
+		if idi in self:
+			self._unlink(idi)
+		super().__setitem__(idi, infos)
+		self.by_q[infos['_q']].add(idi)
+	
+	def __delitem__(self, idi):
+		self._unlink(idi)
+		super().__delitem__(idi)
+	
+	def _unlink(self, idi):
+		combi_query = self[idi]['_q']
+		self.by_q[combi_query].discard(idi)
+		if not self.by_q[combi_query]:
+			del self.by_q[combi_query]
+	
+	def pop(self, idi, *default):
+		if idi in self:
+			self._unlink(idi)
+		return super().pop(idi, *default)
+	
+	def counts_by_combo(self, crit_fields):
+		"""
+		Number of docs for each combo of crit_fields values, counting
+		the docs of any '_q' that has these values (ex: after a RLAX run
+		'corpusName:wiley' counts all 'corpusName:wiley AND ...' docs)
+		
+		Keyed by combo_key(combi_query, crit_fields)
+		
+		(one pass over the distinct '_q', not over the docs)
+		"""
+		counts = defaultdict(int)
+		for combi_query, ids in self.by_q.items():
+			key = combo_key(combi_query, crit_fields)
+			if key is not None:
+				counts[key] += len(ids)
+		return counts
+	
+	def remove_random(self, n):
+		"""
+		Removes n random docs (returns their ids)
+		"""
+		sacrificed = random_sample(list(self.keys()), n)
+		for idi in sacrificed:
+			del self[idi]
+		return sacrificed
+
+
+def get_pools(crit_fields, verbose=False):
+	"""
+	Pool counts for a criteria set
+	
+	Read from the pool_cache if it exists (and refreshed if POOL_REFRESH)
+	otherwise obtained from the API and saved into the pool_cache.
+	
+	Returns the pool_info dict as cached:
+	  'f'    : {combo_query: count}
+	  'nr'   : sum of counts (aka number of answered hits)
+	  'nd'   : docs that have all criteria fields (normalizing constant N)
+	  'totd' : all API docs
+	  'ts'   : {combo_query: timestamp of its count}
+	  'at'   : {combo_query: all API docs at the time of its count}
+	  'cn'   : {corpusName: count} snapshot at the time of the last counts
+	"""
+	# instead do steps (1) (2) maybe we have cached the pools ?
+	# (always same counts for given criteria) => cache to json
+	cache_filename = pool_cache_path(crit_fields)
+	print('...checking cache for %s' % cache_filename,file=stderr)
+	
+	if path.exists(cache_filename):
+		cache = open(cache_filename, 'r')
+		pool_info = load(cache)
+		cache.close()
+		print('...ok cache (%i workdocs)' % pool_info['nd'],file=stderr)
+		
+		if POOL_REFRESH:
+			refresh_pools(pool_info, crit_fields, verbose=verbose)
+			save_pools(pool_info, cache_filename)
+	else:
+		print('...no cache found',file=stderr)
+		
+		# maybe we have cached the pools of a bigger criteria set ?
+		super_fields = find_superset_cache(crit_fields)
+		
+		if super_fields:
+			super_filename = pool_cache_path(super_fields)
+			print('...summing pools from cache %s' % super_filename, file=stderr)
+			cache = open(super_filename, 'r')
+			super_info = load(cache)
+			cache.close()
+			
+			# docs lacking one of the extra fields are in none of the
+			# superset pools => summing is only possible if there are none
+			n_missing = (api.count(" AND ".join([k+":*" for k in crit_fields]))
+			             - api.count(" AND ".join([k+":*" for k in super_fields])))
+			
+			# idem for docs whose extra field value is not in the superset
+			# combos (terms facet truncated at FACET_TRUNCATION buckets)
+			for field in set(super_fields) - set(crit_fields):
+				n_unlisted = unlisted_docs(super_info, super_fields, field)
+				if n_unlisted is None:
+					print('...%s value list truncated: counting pools instead'
+					      % field, file=stderr)
+					n_missing = None
+					break
+				n_missing += n_unlisted
+			
+			if n_missing is None:
+				pool_info = None
+			else:
+				pool_info = marginal_pools(super_info, super_fields, crit_fields,
+				                           n_missing=n_missing)
+				if pool_info is None:
+					print('...%i docs without listed %s: counting pools instead'
+					       % (n_missing, '/'.join(set(super_fields) - set(crit_fields))),
+					      file=stderr)
+		else:
+			pool_info = None
+		
+		if pool_info is None:
+			pool_info = count_all_pools(crit_fields, verbose=verbose)
+		
+		save_pools(pool_info, cache_filename)
+	
+	return pool_info
+
+
+def find_superset_cache(crit_fields):
+	"""
+	Looks in pool_cache for the smallest cached criteria set that
+	contains all crit_fields and whose other fields can be summed out
+	(ie not in MULTIVALUED_FIELDS)
+	
+	Returns this superset's criteria list (or None)
+	"""
+	cache_dir = path.join(HOME, 'pool_cache')
+	if not path.isdir(cache_dir):
+		return None
+	
+	wanted = set(crit_fields)
+	best = None
+	for filename in listdir(cache_dir):
+		if not filename.endswith('.pool.json'):
+			continue
+		cached_fields = filename[:-len('.pool.json')].split('-')
+		extra_fields = set(cached_fields) - wanted
+		if (wanted < set(cached_fields)
+		    and not extra_fields & set(MULTIVALUED_FIELDS)
+		    and (best is None or len(cached_fields) < len(best))):
+			best = cached_fields
+	
+	return best
+
+
+def marginal_pools(super_info, super_fields, crit_fields, n_missing=0):
+	"""
+	Derives the pool_info of crit_fields from the cached pool_info of a
+	superset of criteria, by summing the counts over the extra fields
+	(no API call)
+	
+	NB: the extra fields must be single-valued, so that each doc is
+	    counted in only one of the summed combos. The superset's 'nd'
+	    (docs with all the superset fields) remains the right normalizing
+	    constant since the summed counts come from these same docs.
+	
+	n_missing: number of docs that have all crit_fields but not all the
+	           super_fields (residual absent from the superset pools)
+	           => if not 0, the sums would be too small: returns None
+	"""
+	if n_missing > 0:
+		return None
+	
+	abs_freqs = {}
+	stamps = {}
+	totals = {}
+	super_stamps = super_info.get('ts', {})
+	super_totals = super_info.get('at', {})
+	
+	for super_query, freq in super_info['f'].items():
+		vals = combo_fields(super_query, super_fields)
+		query = " AND ".join([field + ':' + vals[field] for field in crit_fields])
+		
+		abs_freqs[query] = abs_freqs.get(query, 0) + freq
+		
+		# a summed combo is as old as its oldest part
+		stamps[query] = min(stamps.get(query, float('inf')),
+		                    super_stamps.get(super_query, 0))
+		totals[query] = min(totals.get(query, float('inf')),
+		                    super_totals.get(super_query, 0))
+	
+	pool_info = {
+		'f'   : {query:abs_freqs[query] for query in sorted(abs_freqs)},
+		'ts'  : stamps,
+		'at'  : totals,
+		'nr'  : sum(abs_freqs.values()),
+		'nd'  : super_info['nd'],
+		'totd': super_info['totd']
+		}
+	if 'cn' in super_info:
+		pool_info['cn'] = super_info['cn']
+	
+	return pool_info
+
+
+def unlisted_docs(super_info, super_fields, field_name):
+	"""
+	Number of docs whose field_name value is in none of the combos of
+	a cached superset (these docs are absent from its pools)
+	
+	Only the TERMFACET_FIELDS_auto lists can miss values: their terms
+	facet is truncated at FACET_TRUNCATION buckets and new values may
+	have appeared since the superset was cached. The DATE ranges are
+	exhaustive.
+	
+	Returns None if the count can't be known (truncated facet without
+	an "other" count)
+	"""
+	if field_name not in TERMFACET_FIELDS_auto:
+		return 0
+	
+	facet_name = sub('^[^.]+\.', '', field_name)
+	buckets, n_other = api.terms_facet(facet_name, with_other=True)
+	
+	if n_other is None:
+		if len(buckets) >= FACET_TRUNCATION:
+			return None
+		n_other = 0
+	
+	listed = set(combo_fields(query, super_fields)[field_name]
+	             for query in super_info['f'])
+	
+	return n_other + sum(n for val, n in buckets.items() if val not in listed)
+
+
+def count_all_pools(crit_fields, verbose=False):
+	"""
+	Gets the counts of each criteria combo from the API
+	(cf. get_pools for the output format)
+	"""
+	# (1) PARTITIONING THE SEARCH SPACE IN POSSIBLE OUTCOMES --------
+	print("Sending count queries for criteria pools...",file=stderr)
+	## build all "field:values" pairs per criterion field
+	## (list of list of strings: future lucene query chunks)
+	all_possibilities = []
+	for my_criterion in crit_fields:
+		field_outcomes = facet_vals(my_criterion)
+		# lucene query chunks
+		all_possibilities.append(
+			[my_criterion + ':' + val for val in field_outcomes]
+		)
+	
+	
+	## list combos (cartesian product of field_outcomes)
+	# we're directly unpacking *args into itertool.product()
+	# (=> we get an iterator over tuples of combinable query chunks)
+	combinations = product(*all_possibilities)
+	
+	
+	# example for -c corpusName, publicationDate
+	#	[
+	#	('corpusName:ecco', 'publicationDate:[* TO 1959]'),
+	#	('corpusName:ecco', 'publicationDate:[1960 TO 1999]'),
+	#	('corpusName:ecco', 'publicationDate:[2000 TO *]'),
+	#	('corpusName:elsevier', 'publicationDate:[* TO 1959]'),
+	#	('corpusName:elsevier', 'publicationDate:[1960 TO 1999]'),
+	#	('corpusName:elsevier', 'publicationDate:[2000 TO *]'),
+	#	(...)
+	#	]
+	
+	# (2) getting total counts for each criteria --------------------
+	now = time()
+	
+	# do the counting for each combo
+	# (facet requests when possible, otherwise parallel count requests)
+	# (no api response cache: the counts are stamped 'now' below and
+	#  trusted as such by refresh_pools)
+	queries = [" AND ".join(combi) for combi in sorted(combinations)]
+	freqs = facet_pools(all_possibilities, crit_fields, verbose=verbose,
+	                    use_cache=False)
+	
+	# dict of counts for each combo, in sorted order
+	abs_freqs = {query:freqs[query] for query in queries}
+	
+	# snapshot of the API state (for later refresh_pools)
+	doc_grand_total = api.count(q='*', use_cache=False)
+	
+	pool_info = {
+		'f'   : abs_freqs,
+		'ts'  : {query:now for query in queries},
+		'at'  : {query:doc_grand_total for query in queries},
+		'cn'  : api.terms_facet('corpusName', use_cache=False),
+		'totd': doc_grand_total
+		}
+	
+	update_pool_totals(pool_info, crit_fields, verbose=verbose,
+	                   use_cache=False)
+	
+	return pool_info
+
+
+def update_pool_totals(pool_info, crit_fields, verbose=False, use_cache=True):
+	"""
+	(Re)computes 'nr' and 'nd' in pool_info after its counts changed
+	"""
+	# number of counted answers
+	#  (1 doc can give several hits if a criterion was multivalued)
+	pool_info['nr'] = sum(pool_info['f'].values())
+	
+	# number of documents sending answers (hence normalizing constant N)
+	pool_info['nd'] = api.count(" AND ".join([k+":*" for k in crit_fields]),
+	                            use_cache=use_cache)
+	
+	if verbose:
+		print("--------- pool totals -----------", file=stderr)
+		print("#answered hits :   % 12s" % pool_info['nr'], file=stderr)
+		print("#workdocs (N) :    % 12s" % pool_info['nd'], file=stderr)
+		# for comparison: all_docs = N + api.count(q="NOT(criterion:*)")
+		print("#all API docs fyi: % 12s" % pool_info['totd'],file=stderr)
+		print("---------------------------------", file=stderr)
+
+
+def refresh_pools(pool_info, crit_fields, verbose=False):
+	"""
+	Recounts only some of the cached pool combos (in place)
+	
+	POOL_REFRESH == 'stale':   combos counted more than POOL_MAX_AGE ago
+	POOL_REFRESH == 'changed': combos captured when the API had another
+	                           total number of docs AND whose corpus
+	                           changed since then (1 corpusName facet query)
+	
+	Returns the number of recounted combos.
+	"""
+	now = time()
+	abs_freqs = pool_info['f']
+	# old caches have no timestamps => stale
+	stamps = pool_info.setdefault('ts', {})
+	totals = pool_info.setdefault('at', {})
+	
+	# (no api response cache for the refresh: we want new counts)
+	doc_grand_total = api.count(q='*', use_cache=False)
+	
+	if POOL_REFRESH == 'stale':
+		checked = [q for q in abs_freqs
+		             if now - stamps.get(q, 0) > POOL_MAX_AGE]
+		to_recount = checked
+	
+	elif POOL_REFRESH == 'changed':
+		# cheap check n°1: nothing new in the API since capture
+		checked = [q for q in abs_freqs if totals.get(q) != doc_grand_total]
+		to_recount = []
+		
+		if checked:
+			# cheap check n°2: which corpora changed
+			new_corpora = api.terms_facet('corpusName', use_cache=False)
+			old_corpora = pool_info.get('cn')
+			
+			if old_corpora is None:
+				to_recount = checked
+			else:
+				changed = set([c for c in set(old_corpora) | set(new_corpora)
+				                 if old_corpora.get(c) != new_corpora.get(c)])
+				if 'corpusName' in crit_fields:
+					to_recount = [q for q in checked
+					    if combo_fields(q, crit_fields)['corpusName'] in changed]
+				elif changed:
+					# all combos depend on every corpus
+					to_recount = checked
+			
+			pool_info['cn'] = new_corpora
+	
+	else:
+		raise ValueError("unknown pool refresh mode '%s'" % POOL_REFRESH)
+	
+	print('...refreshing %i/%i pools' % (len(to_recount), len(abs_freqs)),
+	      file=stderr)
+	
+	if to_recount:
+		freqs = count_pools(to_recount, verbose=verbose, use_cache=False)
+		for query in to_recount:
+			abs_freqs[query] = freqs[query]
+	
+	# the checked combos are now up to date
+	for query in checked:
+		stamps[query] = now
+		totals[query] = doc_grand_total
+	
+	pool_info['totd'] = doc_grand_total
+	if to_recount:
+		update_pool_totals(pool_info, crit_fields, verbose=verbose,
+		                   use_cache=False)
+	
+	return len(to_recount)
+
+
+def save_pools(pool_info, cache_filename):
+	"""
+	Writes pool_info to the pool_cache (json)
+	"""
+	cache = open(cache_filename, 'w')
+	# json.dump
+	dump(pool_info, cache, indent=1)
+	cache.close()
+
+
+def combo_fields(combi_query, crit_fields=None):
+	"""
+	Splits a combo query back into its criteria values
+	(by default, looks for all the fields allowed as criteria)
+	
+	ex: > combo_fields('corpusName:oup AND language:(NOT eng) AND (NOT deu)',
+	                   ['corpusName','language'])
+	    > {'corpusName': 'oup', 'language': '(NOT eng) AND (NOT deu)'}
+	"""
+	if crit_fields is None:
+		crit_fields = TERMFACET_FIELDS_auto + TERMFACET_FIELDS_local + RANGEFACET_FIELDS
+	
+	# on ne coupe que devant un des champs critères
+	# (les valeurs elles-mêmes peuvent contenir des " AND ")
+	chunks = split(r' AND (?=(?:%s):)' % '|'.join(escape(f) for f in crit_fields),
+	               combi_query)
+	fields = {}
+	for chunk in chunks:
+		field_name, value = chunk.split(':', 1)
+		fields[field_name] = value
+	return fields
+
+
+def combo_key(combi_query, crit_fields):
+	"""
+	Canonical form of a combo query for crit_fields, the same whatever
+	the order of the fields in the query (or None if a field is missing)
+	
+	ex: > combo_key('publicationDate:[* TO 1959] AND corpusName:oup',
+	                ['corpusName','publicationDate'])
+	    > (('corpusName', 'oup'), ('publicationDate', '[* TO 1959]'))
+	"""
+	vals = combo_fields(combi_query)
+	if not all(field in vals for field in crit_fields):
+		return None
+	return tuple(sorted((field, vals[field]) for field in crit_fields))
+
+
+def facet_pools(all_possibilities, crit_fields, verbose=False, use_cache=True):
+	"""
+	Counts for each combo of all_possibilities (lists of 'field:value'
+	chunks, in crit_fields order) with as few requests as possible:
+	
+	  - one criterion is used as a terms facet (an auto-listed one with
+	    the most values, or else a locally listed one)
+	  - 1 facet request within each combo of the other criteria gives
+	    the counts for all the facet values at once
+	  - values that can't be read from the buckets (lucene expressions,
+	    or missing from a truncated bucket list) get a normal count query
+	
+	ex: 'corpusName publicationDate language' => 5 x 4 facet requests on
+	    'corpusName' instead of 5 x 4 x n_corpora count requests
+	
+	Returns a dict {query: count} like count_pools()
+	"""
+	all_queries = [" AND ".join(combi) for combi in product(*all_possibilities)]
+	
+	# choice of the facet criterion
+	facet_i = None
+	for candidate_fields in (TERMFACET_FIELDS_auto, TERMFACET_FIELDS_local):
+		candidates = [i for i, field in enumerate(crit_fields)
+		                if field in candidate_fields]
+		if candidates:
+			facet_i = max(candidates,
+			              key=lambda i: len(facet_plain_values(all_possibilities[i])))
+			break
+	
+	# no facetable criterion => 1 count per non-empty combo
+	if facet_i is None or not facet_plain_values(all_possibilities[facet_i]):
+		freqs = prune_combos(all_possibilities, verbose=verbose,
+		                     use_cache=use_cache)
+		# the pruned combos are empty
+		return {query:freqs.get(query, 0) for query in all_queries}
+	
+	facet_field = crit_fields[facet_i]
+	facet_name = sub(r'^[^.]+\.', '', facet_field)
+	facet_chunks = all_possibilities[facet_i]
+	other_fields = crit_fields[0:facet_i] + crit_fields[facet_i+1:]
+	other_possibilities = all_possibilities[0:facet_i] + all_possibilities[facet_i+1:]
+	
+	# the combos of the other criteria (or everything if only 1 criterion)
+	if len(other_possibilities) > 1:
+		# only below the non-empty combos of the first ones
+		# (the last level is checked by the facet request itself)
+		parents = prune_combos(other_possibilities[0:-1], verbose=verbose,
+		                       use_cache=use_cache)
+		prefixes = [parent + " AND " + chunk for parent in sorted(parents)
+		                                   for chunk in other_possibilities[-1]]
+	elif len(other_possibilities) == 1:
+		prefixes = list(other_possibilities[0])
+	else:
+		prefixes = ['*']
+	
+	print("Sending %i '%s' facet queries for criteria pools..."
+	      % (len(prefixes), facet_name), file=stderr)
+	
+	def facet_one(prefix):
+		return api.terms_facet(facet_name, q=prefix,
+		                       use_cache=use_cache, with_other=True)
+	
+	with ThreadPoolExecutor(max_workers=POOL_WORKERS) as executor:
+		facets = list(executor.map(facet_one, prefixes))
+	
+	# reading the counts in the buckets
+	# (the combos under a pruned prefix are empty)
+	freqs = {query:0 for query in all_queries}
+	to_count = []
+	for prefix, (buckets, n_other) in zip(prefixes, facets):
+		truncated = (n_other > 0 if n_other is not None
+		             else len(buckets) >= FACET_TRUNCATION)
+		prefix_vals = {} if prefix == '*' else combo_fields(prefix, other_fields)
+		
+		for chunk in facet_chunks:
+			value = chunk.split(':', 1)[1]
+			# full query with the chunks in crit_fields order
+			vals = dict(prefix_vals)
+			vals[facet_field] = value
+			query = " AND ".join([field + ':' + vals[field] for field in crit_fields])
+			
+			if not search(PLAIN_VALUE, value):
+				to_count.append(query)
+			elif value in buckets:
+				freqs[query] = buckets[value]
+			elif truncated:
+				to_count.append(query)
+			else:
+				freqs[query] = 0
+			
+			if verbose and query in freqs:
+				print("pool:'% -30s': % 8i" %(query,freqs[query]),file=stderr)
+	
+	# the rest with normal counts
+	if to_count:
+		freqs.update(count_pools(to_count, verbose=verbose, use_cache=use_cache))
+	
+	return freqs
+
+
+def prune_combos(possibilities, verbose=False, use_cache=True):
+	"""
+	Counts the combos of possibilities (lists of 'field:value' chunks)
+	level by level, only expanding the non-empty combos of each level:
+	
+	   level 1: 'corpusName:eebo', 'corpusName:elsevier', ...
+	   level 2: 'corpusName:eebo AND publicationDate:[1960 TO 1979]', ...
+	            (nothing under a level 1 combo with count 0)
+	   ...
+	
+	=> the number of count requests follows the non-empty combos
+	   instead of the whole cartesian product
+	
+	Returns a dict {query: count} of the non-empty last level combos
+	"""
+	level = {'': None}
+	for i, chunks in enumerate(possibilities):
+		queries = [(parent + " AND " + chunk if parent else chunk)
+		             for parent in sorted(level) for chunk in chunks]
+		if verbose or i > 0:
+			print("pruning level %i: %i queries" % (i+1, len(queries)),
+			      file=stderr)
+		counts = count_pools(queries, verbose=verbose, use_cache=use_cache)
+		level = {query:n for query, n in counts.items() if n > 0}
+	
+	return level
+
+
+def facet_plain_values(chunks):
+	"""
+	The 'field:value' chunks whose value can be read in a terms facet
+	"""
+	return [chunk for chunk in chunks
+	          if search(PLAIN_VALUE, chunk.split(':', 1)[1])]
+
+
+def count_pools(queries, workers=None, verbose=False, use_cache=True):
+	"""
+	Runs api.count() for a list of queries with a pool of threads
+	(the global rate limit of the api session still applies)
+	
+	Returns a dict {query: count}
+	"""
+	if not workers:
+		workers = POOL_WORKERS
+	
+	def count_one(query):
+		return api.count(query, use_cache=use_cache)
+	
+	n_queries = len(queries)
+	freqs = {}
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		# map keeps the order of the queries
+		for i, (query, freq) in enumerate(
+		         zip(queries, executor.map(count_one, queries))):
+			if i % 100 == 0:
+				print("pool %i/%i" % (i,n_queries), file=stderr)
+			if verbose:
+				print("pool:'% -30s': % 8i" %(query,freq),file=stderr)
+			freqs[query] = freq
+	
+	return freqs
+
+
 def pool_cache_path(criteria_list):
 	"""pool_cache filename: sorted-criteria-of-the-set.pool.json"""
 	global HOME
@@ -682,12 +1649,30 @@ def safe_str(a_string=""):
 def full_run(arglist=None):
 	global LOG
 	global LISSAGE
+	global POOL_WORKERS
+	global POOL_REFRESH
+	global POOL_MAX_AGE
+	global RANDOM_SEED
+	global JOURNAL
 	# output lines for direct use or print to STDOUT if __main__
 	output_array = []
 	
 	# cli arguments
 	args = my_parse_args(arglist)
 	
+	# parallel requests: as many pooled connections as workers
+	POOL_WORKERS = args.pool_workers
+	api.set_session(pool_size=POOL_WORKERS, max_rate=args.max_rate)
+	if args.no_cache:
+		api.RESPONSE_CACHE.bypass = True
+	
+	# random ranking of the hits
+	RANDOM_SEED = args.random_seed
+	
+	# updates of the cached pools
+	POOL_REFRESH = args.refresh_pools
+	POOL_MAX_AGE = args.max_age * 86400
+	
 	# do we need to change smoothing ?
 	if args.smoothing_init and float(args.smoothing_init) > 0:
 		print("Setting initial smoothing to %.2f" % args.smoothing_init, file=stderr)
@@ -699,6 +1684,26 @@ def full_run(arglist=None):
 	LOG.append('CRIT: fields(%s)' % ", ".join(args.criteria_list))
 	if args.with_constraint_query:
 		LOG.append('WITH: constraint query "%s"' % args.with_constraint_query)
+	if RANDOM_SEED is not None:
+		LOG.append('RAND: random ranking with seed %i' % RANDOM_SEED)
+	
+	# checkpoints (the params must be the same to resume)
+	try:
+		JOURNAL = SampleJournal(args.state_file, {
+			'n'   : args.sample_size,
+			'crit': list(args.criteria_list),
+			'with': args.with_constraint_query,
+			'x'   : args.exclude_list_path,
+			'seed': args.random_seed,
+			'smoo': args.smoothing_init,
+			}, resume=args.resume)
+	except ValueError as state_e:
+		print("ERR: cannot resume (%s)" % state_e, file=stderr)
+		exit(1)
+	if args.resume:
+		LOG.append('RSUM: resumed from %s' % args.state_file)
+		# the pools were already updated and saved by the interrupted run
+		POOL_REFRESH = None
 	
 	run_counter = 0
 	
@@ -791,13 +1796,14 @@ def full_run(arglist=None):
 	
 	# IF overflow => random pruning
 	if n_ids > args.sample_size:
-		deck = [did for did in got_ids_idx.keys()]
 		# random removal of excess documents
-		shuffle(deck)
 		nd = n_ids - args.sample_size
-		sacrificed = deck[0:nd]
-		for did in sacrificed:
-			del got_ids_idx[did]
+		if JOURNAL.xdel is not None:
+			# same pruning as before the interruption
+			for idi in JOURNAL.xdel:
+				del got_ids_idx[idi]
+		else:
+			JOURNAL.record_xdel(got_ids_idx.remove_random(nd))
 		LOG.append("XDEL: sacrificing %i random docs" % nd)
 	
 	# last recount
@@ -806,6 +1812,10 @@ def full_run(arglist=None):
 	
 	# -------------- OUTPUT --------------------------------------------
 	
+	# infos for the final sample only
+	if args.out_type in ['tab', 'docs']:
+		enrich_index(got_ids_idx, verbose=args.verbose)
+	
 	# ***(ids)***
 	if args.out_type == 'ids':
 		for did, info in sorted(got_ids_idx.items(), key=lambda x: x[1]['_q']):
@@ -819,7 +1829,7 @@ def full_run(arglist=None):
 						 'author_1','lang','doctype_1','cat_sci', 'title']))
 		# contents
 		for did, info in sorted(got_ids_idx.items(), key=lambda x: x[1]['_q']):
-			# provenance: sample() => boucle par hits (l.500 ++)
+			# provenance: enrich_index() => hit_info()
 			# print("INFO----------",info, file=stderr)
 			# exit()
 			
@@ -857,11 +1867,15 @@ def full_run(arglist=None):
 			ids, basenames,
 			tgt_dir=my_dir,
 			api_types=['metadata/xml',
-					   'fulltext/pdf']
+					   'fulltext/pdf'],
+			workers=POOL_WORKERS
 		)
 		
 		LOG.append("SAVE: saved docs in %s/" % my_dir)
 	
+	# everything went fine: no more need for the checkpoints
+	JOURNAL.finish()
+	JOURNAL = None
 	
 	return (output_array, LOG)
 
@@ -0,0 +1,169 @@
+#! /usr/bin/python3
+
+import unittest
+
+# tools
+import asyncio
+from threading        import Thread
+from http.server      import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.error     import HTTPError
+from unittest.mock    import patch
+from hashlib          import sha1
+from tempfile         import mkdtemp
+from shutil           import rmtree
+from os               import path
+
+# the tested module
+import aioapi
+
+BODY = b'{"total": 42}' * 1000
+
+class LocalHandler(BaseHTTPRequestHandler):
+	"""
+	Local http 1.1 server with the cases handled by AsyncSession
+	"""
+	protocol_version = 'HTTP/1.1'
+	# request lines received (cf. proxy test)
+	seen = []
+	
+	def do_GET(self):
+		LocalHandler.seen.append(self.path)
+		if self.path.startswith('http://'):
+			# absolute url: we are the proxy
+			self.path = '/' + self.path.split('/', 3)[3]
+		if self.path == '/length':
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(BODY)))
+			self.end_headers()
+			self.wfile.write(BODY)
+		elif self.path == '/chunked':
+			self.send_response(200)
+			self.send_header('Transfer-Encoding', 'chunked')
+			self.end_headers()
+			for i in range(0, len(BODY), 5000):
+				chunk = BODY[i:i+5000]
+				self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+			self.wfile.write(b'0\r\n\r\n')
+		elif self.path == '/redirect':
+			self.send_response(302)
+			self.send_header('Location', '/length')
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+		elif self.path.endswith('/busy/fulltext/pdf'):
+			self.send_response(429)
+			self.send_header('Retry-After', '1')
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+		elif self.path.endswith('/ok/fulltext/pdf'):
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(BODY)))
+			self.end_headers()
+			self.wfile.write(BODY)
+		else:
+			self.send_response(404)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+	
+	def log_message(self, *args):
+		pass
+
+
+class TestAioApi(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.server = ThreadingHTTPServer(('127.0.0.1', 0), LocalHandler)
+		Thread(target=cls.server.serve_forever, daemon=True).start()
+		cls.host = '127.0.0.1:%i' % cls.server.server_port
+		cls.base = 'http://' + cls.host
+	
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+	
+	def get(self, route, amt=None):
+		"Body of route (read by amt bytes if given) and the session pools"
+		async def main():
+			async with aioapi.AsyncSession() as s:
+				async with await s.open(self.base + route) as resp:
+					if amt is None:
+						body = await resp.read()
+					else:
+						chunks = []
+						while True:
+							chunk = await resp.read(amt)
+							if not chunk:
+								break
+							chunks.append(chunk)
+						body = b''.join(chunks)
+				return (body, resp.url,
+				        sum(len(pool) for pool in s._pools.values()))
+		return asyncio.run(main())
+	
+	def test_1_content_length(self):
+		"Checks a Content-Length body and its connection back to the pool"
+		body, url, n_idle = self.get('/length')
+		self.assertEqual(body, BODY)
+		self.assertEqual(n_idle, 1)
+	
+	def test_2_chunked(self):
+		"Checks a chunked body, read at once or by small reads"
+		body, url, n_idle = self.get('/chunked')
+		self.assertEqual(body, BODY)
+		self.assertEqual(n_idle, 1)
+		body, url, n_idle = self.get('/chunked', amt=777)
+		self.assertEqual(body, BODY)
+	
+	def test_3_redirect(self):
+		"Checks a redirection is followed"
+		body, url, n_idle = self.get('/redirect')
+		self.assertEqual(body, BODY)
+		self.assertEqual(url, self.base + '/length')
+	
+	def test_4_not_found(self):
+		"Checks a 404 raises HTTPError like urlopen"
+		with self.assertRaises(HTTPError) as cm:
+			self.get('/nothing')
+		self.assertEqual(cm.exception.getcode(), 404)
+	
+	def test_5_fetch_fulltext(self):
+		"Checks fetch_fulltext: None if 404, raises if 429, else the file"
+		local_url = lambda DID, api_type, api_conf: (self.base + '/document/'
+		                                             + DID + '/' + api_type)
+		tgt_dir = mkdtemp()
+		async def main():
+			async with aioapi.AsyncSession() as s:
+				absent = await aioapi.fetch_fulltext('nothing', session=s)
+				with self.assertRaises(HTTPError) as cm:
+					await aioapi.fetch_fulltext('busy', session=s)
+				self.assertEqual(cm.exception.getcode(), 429)
+				# headers read whatever their case (like urlopen's)
+				self.assertEqual(cm.exception.headers['retry-after'], '1')
+				self.assertEqual(aioapi.api.retry_after(cm.exception.headers), 1)
+				written = await aioapi.fetch_fulltext('ok', session=s,
+				                       tgt_path=path.join(tgt_dir, 'ok.pdf'))
+				return absent, written
+		try:
+			with patch.object(aioapi.api, 'fulltext_url', local_url):
+				absent, written = asyncio.run(main())
+			self.assertIsNone(absent)
+			self.assertEqual(written, (len(BODY), sha1(BODY).hexdigest()))
+			with open(path.join(tgt_dir, 'ok.pdf'), 'rb') as fh:
+				self.assertEqual(fh.read(), BODY)
+		finally:
+			rmtree(tgt_dir)
+	
+	def test_6_proxy(self):
+		"Checks plain http goes to the proxy with an absolute url"
+		async def main():
+			proxies = {'http': self.base}
+			async with aioapi.AsyncSession(proxies=proxies) as s:
+				async with await s.open('http://docs.invalid/length') as resp:
+					return await resp.read()
+		LocalHandler.seen = []
+		self.assertEqual(asyncio.run(main()), BODY)
+		self.assertEqual(LocalHandler.seen, ['http://docs.invalid/length'])
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
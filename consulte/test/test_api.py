@@ -4,7 +4,14 @@ import unittest
 
 # tools
 from urllib.request   import urlopen
+from urllib.error     import HTTPError
 from http.client      import HTTPResponse
+from http.server      import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading        import Thread
+from unittest.mock    import patch
+from tempfile         import TemporaryDirectory
+from os               import path
+from time             import monotonic
 
 # the tested module
 # £TODO check if import ok
@@ -54,5 +61,223 @@ class TestApi(unittest.TestCase):
 		self.assertEqual(tei[0:5], '<?xml')
 
 
+BODY = b'{"total": 42}' * 1000
+
+class LocalHandler(BaseHTTPRequestHandler):
+	"""
+	Local http 1.1 server (also answers as a proxy: absolute paths)
+	"""
+	protocol_version = 'HTTP/1.1'
+	# (path, client port) of each request
+	seen = []
+	# number of 503 answers left on /busy
+	busy_left = 0
+	
+	def do_GET(self):
+		LocalHandler.seen.append((self.path, self.client_address[1]))
+		route = '/' + self.path.split('/', 3)[-1] if '://' in self.path else self.path
+		if route == '/length':
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(BODY)))
+			self.end_headers()
+			self.wfile.write(BODY)
+		elif route == '/busy':
+			if LocalHandler.busy_left > 0:
+				LocalHandler.busy_left -= 1
+				self.send_response(503)
+				self.send_header('Retry-After', '2')
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+			else:
+				self.send_response(200)
+				self.send_header('Content-Length', '13')
+				self.end_headers()
+				self.wfile.write(b'{"total": 42}')
+		elif route == '/redirect':
+			self.send_response(302)
+			self.send_header('Location', '/length')
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+		else:
+			self.send_response(404)
+			self.send_header('Content-Length', '9')
+			self.end_headers()
+			self.wfile.write(b'not found')
+	
+	def log_message(self, *args):
+		pass
+
+
+class TestHTTPSession(unittest.TestCase):
+	"""
+	api.HTTPSession and PooledResponse against a local http.server
+	"""
+	@classmethod
+	def setUpClass(cls):
+		cls.server = ThreadingHTTPServer(('127.0.0.1', 0), LocalHandler)
+		Thread(target=cls.server.serve_forever, daemon=True).start()
+		cls.host = '127.0.0.1:%i' % cls.server.server_port
+		cls.base = 'http://' + cls.host
+	
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+	
+	def setUp(self):
+		LocalHandler.seen = []
+		self.session = api.HTTPSession(proxies={})
+	
+	def tearDown(self):
+		self.session.close()
+	
+	def test_1_keep_alive(self):
+		"Checks successive requests reuse the same pooled connection"
+		for i in range(3):
+			with self.session.open(self.base + '/length') as resp:
+				self.assertEqual(resp.getcode(), 200)
+				self.assertEqual(resp.read(), BODY)
+		self.assertEqual(len(set(port for _, port in LocalHandler.seen)), 1)
+		self.assertEqual(self.session._pool('http', self.host).qsize(), 1)
+	
+	def test_2_partial_read(self):
+		"Checks a response closed before its end drops its connection"
+		resp = self.session.open(self.base + '/length')
+		resp.read(10)
+		resp.close()
+		self.assertEqual(self.session._pool('http', self.host).qsize(), 0)
+	
+	def test_3_redirect(self):
+		"Checks a redirection is followed"
+		with self.session.open(self.base + '/redirect') as resp:
+			self.assertEqual(resp.read(), BODY)
+			self.assertEqual(resp.geturl(), self.base + '/length')
+	
+	def test_4_http_error(self):
+		"Checks a 404 raises HTTPError like urlopen (with its body)"
+		with self.assertRaises(HTTPError) as cm:
+			self.session.open(self.base + '/nothing')
+		self.assertEqual(cm.exception.getcode(), 404)
+		self.assertEqual(cm.exception.read(), b'not found')
+	
+	def test_5_proxy(self):
+		"Checks plain http goes to the proxy with absolute urls, unless no_proxy"
+		session = api.HTTPSession(proxies={'http': self.base})
+		with session.open('http://api.example.org/length') as resp:
+			self.assertEqual(resp.read(), BODY)
+		self.assertEqual(LocalHandler.seen[0][0], 'http://api.example.org/length')
+		with patch.dict('os.environ', {'no_proxy': 'api.example.org'}):
+			self.assertIsNone(session._proxy('http', 'api.example.org'))
+		self.assertIsNotNone(session._proxy('http', 'other.example.org'))
+		self.assertIsNone(session._proxy('https', 'api.example.org'))
+		session.close()
+	
+	def test_6_retry(self):
+		"Checks _get retries a 503 after its Retry-After and slows the host down"
+		LocalHandler.busy_left = 1
+		with patch.object(api, 'SESSION', self.session), \
+		     patch.object(api, 'sleep') as fake_sleep:
+			json_values = api._get(self.base + '/busy', use_cache=False)
+		self.assertEqual(json_values, {'total': 42})
+		self.assertEqual(len(LocalHandler.seen), 2)
+		fake_sleep.assert_any_call(2.0)
+		# AIMD: rate halved after the 503, then +1/rate after the success
+		rate = api.THROTTLE_START_RATE / 2
+		self.assertAlmostEqual(self.session._bucket(self.host).rate,
+		                       rate + 1 / rate)
+
+
+class TestRateAndStores(unittest.TestCase):
+	"""
+	Offline checks of the retry delays, TokenBucket, ResponseCache and HitStore
+	"""
+	def test_1_retry_after_cap(self):
+		"Checks Retry-After values (seconds or http date) are capped"
+		self.assertEqual(api.retry_after({'Retry-After': '3'}), 3)
+		self.assertEqual(api.retry_after({'Retry-After': '86400'}),
+		                 api.BACKOFF_MAX)
+		self.assertEqual(api.retry_after(
+		                     {'Retry-After': 'Fri, 31 Dec 2100 23:59:59 GMT'}),
+		                 api.BACKOFF_MAX)
+		self.assertEqual(api.retry_after(
+		                     {'Retry-After': 'Thu, 01 Jan 1970 00:00:00 GMT'}), 0)
+		self.assertIsNone(api.retry_after({'Retry-After': 'soon'}))
+		self.assertIsNone(api.retry_after({}))
+		# without Retry-After: exponential backoff with jitter, capped too
+		for attempt in range(12):
+			delay = api.backoff_delay(attempt)
+			self.assertLessEqual(delay, api.BACKOFF_MAX)
+			self.assertGreaterEqual(delay,
+			                 min(api.BACKOFF_MAX, api.BACKOFF_BASE * 2**attempt) / 2)
+	
+	def test_2_aimd(self):
+		"Checks TokenBucket halves its rate, then raises it slowly up to max_rate"
+		bucket = api.TokenBucket(8, max_rate=10)
+		bucket.slow_down()
+		self.assertEqual(bucket.rate, 4)
+		bucket.speed_up()
+		self.assertEqual(bucket.rate, 4.25)
+		for i in range(100):
+			bucket.speed_up()
+		self.assertEqual(bucket.rate, 10)
+		for i in range(20):
+			bucket.slow_down()
+		self.assertEqual(bucket.rate, api.THROTTLE_MIN_RATE)
+		# the server's Retry-After pauses the requests
+		bucket.slow_down(pause=30)
+		self.assertGreater(bucket.paused_until, monotonic() + 29)
+	
+	def test_3_cache_ttl_lru(self):
+		"Checks ResponseCache ignores expired entries and evicts the least used"
+		clock = [1000.0]
+		with TemporaryDirectory() as tmp_dir, \
+		     patch.object(api, 'time', lambda: clock[0]):
+			cache = api.ResponseCache(path.join(tmp_dir, 'r.sqlite'),
+			                          ttl=60, max_entries=10)
+			cache.put('http://h/x?b=2&a=1', b'{}')
+			# same key whatever the params order
+			self.assertEqual(cache.get('http://h/x?a=1&b=2'), b'{}')
+			clock[0] += 61
+			self.assertIsNone(cache.get('http://h/x?a=1&b=2'))
+			
+			cache.clear()
+			for i in range(10):
+				clock[0] += 1
+				cache.put('http://h/q?i=%i' % i, b'%i' % i)
+			# i=0 used again: i=1 and i=2 become the least recently used
+			clock[0] += 1
+			self.assertEqual(cache.get('http://h/q?i=0'), b'0')
+			clock[0] += 1
+			cache.put('http://h/q?i=10', b'10')
+			self.assertEqual(cache.get('http://h/q?i=0'), b'0')
+			self.assertIsNone(cache.get('http://h/q?i=1'))
+			self.assertIsNone(cache.get('http://h/q?i=2'))
+			self.assertEqual(cache.get('http://h/q?i=3'), b'3')
+			self.assertEqual(cache.get('http://h/q?i=10'), b'10')
+			cache.close()
+	
+	def test_4_hit_store(self):
+		"Checks HitStore indexing, slices and iteration (over several pages)"
+		hits = [{'id': '%040X' % i, 'title': 'doc %i' % i} for i in range(2500)]
+		store = api.HitStore()
+		store.extend(iter(hits), batch_size=700)
+		try:
+			self.assertEqual(len(store), 2500)
+			self.assertEqual(store[0], hits[0])
+			self.assertEqual(store[-1], hits[-1])
+			self.assertEqual(store[995:1005], hits[995:1005])
+			self.assertEqual(store[::600], hits[::600])
+			self.assertEqual(store[2490:3000], hits[2490:])
+			self.assertEqual(list(store), hits)
+			self.assertEqual(store.get(hits[1234]['id']), hits[1234])
+			self.assertIsNone(store.get('nothing'))
+			with self.assertRaises(IndexError):
+				store[2500]
+		finally:
+			tmp_path = store.path
+			store.close()
+		self.assertFalse(path.exists(tmp_path))
+
+
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
\ No newline at end of file
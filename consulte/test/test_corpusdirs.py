@@ -0,0 +1,187 @@
+#! /usr/bin/python3
+
+import unittest
+
+# tools
+from tempfile         import mkdtemp
+from shutil           import rmtree
+from os               import path, makedirs, utime, stat
+from re               import search, sub, escape, MULTILINE
+from unittest.mock    import patch
+
+# the tested module
+import corpusdirs
+
+# a native XML bigger than the prolog read by dtd_repair_file
+# (with 2-bytes chars so that PROLOG_SIZE cuts one of them)
+BIG_XML = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           + '<!DOCTYPE article PUBLIC "-//ES//DTD journal article DTD version 5.2.0//EN//XML"\n'
+           + ' "http://www.elsevier.com/xml/ja/dtd/art520.dtd" [<!ENTITY gr1 SYSTEM "gr1" NDATA IMAGE>]>\n'
+           + '<article>' + 'é' * (corpusdirs.PROLOG_SIZE + 12345)
+           + ' art520.dtd </article>\n').encode('UTF-8')
+
+def crashing_repair(fi, tgt_path, dtd_prefix, crash_on):
+	"""
+	dtd_repair_file interrupted at the file crash_on (module-level: run
+	in the transform_shelf processes)
+	"""
+	if path.basename(fi) == crash_on:
+		raise KeyboardInterrupt
+	return corpusdirs.dtd_repair_file(fi, tgt_path, dtd_prefix)
+
+def old_dtd_repair(long_str, dtd_prefix):
+	"""
+	The former whole-file version of the repair (reference output)
+	"""
+	m = search(r'(<!DOCTYPE[^>]+(?:PUBLIC|SYSTEM)[^>]*)"([^"]+\.dtd)"((?:\[[^\]]*\])?[^>]*>)',
+	           long_str, MULTILINE)
+	left_hand_side, dtd_uri, right_hand_side = m.groups()
+	new_dtd_path = dtd_prefix + '/' + path.basename(dtd_uri)
+	original_declaration = left_hand_side+'"'+dtd_uri+'"'+right_hand_side
+	new_declaration = left_hand_side+'"'+new_dtd_path+'"'+right_hand_side
+	return sub(escape(original_declaration), new_declaration, long_str)
+
+
+class TestCorpusdirs(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = mkdtemp()
+		self.src = path.join(self.tmp_dir, 'els-1.xml')
+		self.tgt = path.join(self.tmp_dir, '.part-els-1.xml')
+		with open(self.src, 'wb') as fh:
+			fh.write(BIG_XML)
+		self.expected = old_dtd_repair(BIG_XML.decode('UTF-8'),
+		                               '/our/dtd_mashup').encode('UTF-8')
+	
+	def tearDown(self):
+		rmtree(self.tmp_dir)
+	
+	def repaired(self):
+		with open(self.tgt, 'rb') as fh:
+			return fh.read()
+	
+	def test_1_dtd_repair_big_file(self):
+		"Checks the prolog splice gives the same bytes as the old re.sub"
+		status = corpusdirs.dtd_repair_file(self.src, self.tgt, '/our/dtd_mashup')
+		self.assertEqual(status, 'ok')
+		self.assertEqual(self.repaired(), self.expected)
+		# a file without DTD: nothing written
+		with open(self.src, 'wb') as fh:
+			fh.write(b'<?xml version="1.0"?><root xmlns="http://www.wiley.com/ns"/>')
+		self.assertEqual(corpusdirs.dtd_repair_file(self.src, self.tgt + '2', '/our/dtd_mashup'),
+		                 'no_dtd_wiley')
+		self.assertFalse(path.exists(self.tgt + '2'))
+	
+	def test_2_copy_tail_fallbacks(self):
+		"Checks the same output when the kernel copies are unavailable"
+		no_copy = OSError(18, 'Invalid cross-device link')
+		# copy_file_range fails => sendfile
+		with patch.object(corpusdirs.os, 'copy_file_range',
+		                  side_effect=no_copy, create=True):
+			corpusdirs.dtd_repair_file(self.src, self.tgt, '/our/dtd_mashup')
+		self.assertEqual(self.repaired(), self.expected)
+		# both fail => copyfileobj
+		with patch.object(corpusdirs.os, 'copy_file_range',
+		                  side_effect=no_copy, create=True), \
+		     patch.object(corpusdirs.os, 'sendfile',
+		                  side_effect=no_copy, create=True):
+			corpusdirs.dtd_repair_file(self.src, self.tgt, '/our/dtd_mashup')
+		self.assertEqual(self.repaired(), self.expected)
+	
+	def test_3_transform_resume(self):
+		"Checks transform_shelf resumes after a crash and a new download"
+		ids = ['%040X' % i for i in range(1, 4)]
+		tab = ["istex_id\tcorpus\ttitle"] + ["%s\tels\tT%i" % (idi, i)
+		                                     for i, idi in enumerate(ids)]
+		corpus = corpusdirs.Corpus('c', new_infos=tab, new_home=self.tmp_dir)
+		makedirs(corpus.shelf_path('XMLN'))
+		fids = corpus.fileids('XMLN')
+		manifest = corpusdirs.DownloadManifest(
+		               path.join(corpus.cdir, 'meta', 'download_manifest.tsv'))
+		for fi in fids:
+			with open(fi, 'wb') as fh:
+				fh.write(BIG_XML)
+			manifest.record(fi, 'ok', len(BIG_XML), corpusdirs.file_sha1(fi))
+		
+		# crash at the 3rd file (the first 2 are repaired and journaled)
+		with patch.object(corpusdirs, 'TRANSFORM_CHUNK', 1):
+			with self.assertRaises(KeyboardInterrupt):
+				corpus.transform_shelf('XMLN', crashing_repair,
+				                       fn_args=('/our/dtd_mashup',
+				                                path.basename(fids[2])),
+				                       name='dtd_repair', workers=1)
+		
+		# repaired or not, no file to download again for a --resume
+		manifest = corpusdirs.DownloadManifest(manifest.path, verify=True)
+		for fi in fids:
+			self.assertTrue(manifest.is_complete(fi))
+		
+		# ... but say the 1st one is downloaded again anyway
+		with open(fids[0], 'wb') as fh:
+			fh.write(BIG_XML)
+		mtime = stat(fids[0]).st_mtime_ns + 10**9
+		utime(fids[0], ns=(mtime, mtime))
+		
+		statuses = corpus.transform_shelf('XMLN', corpusdirs.dtd_repair_file,
+		                                  fn_args=('/our/dtd_mashup',),
+		                                  name='dtd_repair', workers=2)
+		self.assertEqual(set(statuses.values()), {'ok'})
+		for fi in fids:
+			with open(fi, 'rb') as fh:
+				self.assertEqual(fh.read(), self.expected)
+		self.assertFalse(path.exists(path.join(corpus.cdir, 'meta',
+		                                       'dtd_repair.journal.tsv')))
+	
+	def test_4_dtd_repair_twice(self):
+		"Checks a 2nd repair with the same prefix leaves the file untouched"
+		status, new_file = corpusdirs.transform_file(corpusdirs.dtd_repair_file,
+		                                             self.src, ('/our/dtd_mashup',))
+		self.assertEqual(status, 'ok')
+		self.assertIsNotNone(new_file)
+		utime(self.src, ns=(10**18, 10**18))
+		status, new_file = corpusdirs.transform_file(corpusdirs.dtd_repair_file,
+		                                             self.src, ('/our/dtd_mashup',))
+		self.assertEqual(status, 'ok')
+		self.assertIsNone(new_file)
+		self.assertEqual(stat(self.src).st_mtime_ns, 10**18)
+		with open(self.src, 'rb') as fh:
+			self.assertEqual(fh.read(), self.expected)
+	
+	def test_5_pub2tei_report(self):
+		"Checks the pub2tei report is appended to and only_failed retries the failures"
+		ids = ['%040X' % i for i in range(1, 4)]
+		tab = ["istex_id\tcorpus\ttitle"] + ["%s\tels\tT%i" % (idi, i)
+		                                     for i, idi in enumerate(ids)]
+		corpus = corpusdirs.Corpus('c', new_infos=tab, new_home=self.tmp_dir)
+		makedirs(corpus.shelf_path('XMLN'))
+		fids = corpus.fileids('XMLN')
+		for fi in fids:
+			with open(fi, 'wb') as fh:
+				fh.write(BIG_XML)
+		corpus.shelfs['XMLN'] = True
+		report_path = path.join(corpus.cdir, 'meta', 'pub2tei_report.tsv')
+		
+		calls = []
+		def fake_transform(xsl_path, params, pairs, n_shards, debug_lvl):
+			calls.append([src for src, tgt in pairs])
+			return {src: src != fids[1] or len(calls) > 1 for src, tgt in pairs}
+		
+		with patch.object(corpusdirs.xslt, 'transform_sharded', fake_transform):
+			corpus.pub2goldtei()
+			report = corpusdirs.TransformJournal(report_path)
+			report.close()
+			self.assertEqual([report.status(fi) for fi in fids],
+			                 ['ok', 'failed', 'ok'])
+			
+			# only the failed doc + a doc whose native XML changed since
+			utime(fids[2], ns=(10**18, 10**18))
+			corpus.pub2goldtei(only_failed=True)
+			self.assertEqual(calls[1], [fids[1], fids[2]])
+		
+		report = corpusdirs.TransformJournal(report_path)
+		report.close()
+		self.assertEqual([report.status(fi) for fi in fids], ['ok'] * 3)
+		with open(report_path) as rfh:
+			self.assertEqual(len(rfh.readlines()), 5)
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
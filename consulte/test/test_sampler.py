@@ -1,6 +1,9 @@
 #! /usr/bin/python3
 
 import unittest
+from tempfile import TemporaryDirectory
+from os import path, mkdir, utime
+from unittest.mock import patch
 
 # the tested module
 # £TODO check if import ok
@@ -39,6 +42,165 @@ class TestSampler(unittest.TestCase):
 		first_query = hit_index[id0]['_q']
 		left_side = first_query.split(':')[0]
 		self.assertEqual(left_side, mon_crit)
+	
+	def test_4_marginal_pools(self):
+		"Check pools summed out of a cached criteria superset"
+		super_fields = ['corpusName', 'language']
+		super_info = {
+			'f': {
+				'corpusName:oup AND language:eng': 10,
+				'corpusName:oup AND language:(NOT eng) AND (NOT deu)': 3,
+				'corpusName:bmj AND language:eng': 5,
+				},
+			'nd': 18,
+			'totd': 100
+			}
+		pool_info = sampler.marginal_pools(super_info, super_fields, ['language'])
+		self.assertEqual(pool_info['f'], {
+				'language:(NOT eng) AND (NOT deu)': 3,
+				'language:eng': 15,
+				})
+		self.assertEqual(pool_info['nr'], 18)
+		self.assertEqual(pool_info['nd'], 18)
+
+	def test_5_allocate_quotas(self):
+		"Check quotas sum exactly to the sample size, within the caps"
+		freqs = {'corpusName:oup': 60, 'corpusName:bmj': 25,
+		         'corpusName:ecco': 10, 'corpusName:nature': 5}
+		quotas = sampler.allocate_quotas(7, freqs, 100)
+		self.assertEqual(sum(quotas.values()), 7)
+		self.assertEqual(quotas['corpusName:oup'], 4)
+		# a capped pool gives its share to the others
+		quotas = sampler.allocate_quotas(7, freqs, 100,
+		                                 smoothing=0.2,
+		                                 caps={'corpusName:oup': 2})
+		self.assertEqual(quotas['corpusName:oup'], 2)
+		self.assertEqual(sum(quotas.values()), 7)
+	
+	def test_6_marginal_pools_residual(self):
+		"Check no pools are summed if docs lack a summed-out field"
+		super_fields = ['corpusName', 'publicationDate']
+		super_info = {
+			'f': {
+				'corpusName:springer AND publicationDate:[* TO 1959]': 4,
+				'corpusName:springer AND publicationDate:[1960 TO *]': 6,
+				},
+			'nd': 10,
+			'totd': 100
+			}
+		# 5 springer docs have no publicationDate
+		pool_info = sampler.marginal_pools(super_info, super_fields,
+		                                   ['corpusName'], n_missing=5)
+		self.assertIsNone(pool_info)
+		pool_info = sampler.marginal_pools(super_info, super_fields,
+		                                   ['corpusName'], n_missing=0)
+		self.assertEqual(pool_info['f'], {'corpusName:springer': 10})
+	
+	def test_7_counts_by_combo_order(self):
+		"Check retrieved counts match whatever the criteria order"
+		index = sampler.SampleIndex({
+			'A': {'_q': 'corpusName:oup AND publicationDate:[* TO 1959]'},
+			'B': {'_q': 'corpusName:oup AND publicationDate:[* TO 1959]'},
+			'C': {'_q': 'corpusName:bmj AND publicationDate:[* TO 1959]'},
+			})
+		# cached combo written by a '-c corpusName publicationDate' run
+		# and criteria given as '-c publicationDate corpusName'
+		crit_fields = ['publicationDate', 'corpusName']
+		counts = index.counts_by_combo(crit_fields)
+		cached_query = 'corpusName:oup AND publicationDate:[* TO 1959]'
+		self.assertEqual(counts[sampler.combo_key(cached_query, crit_fields)], 2)
+		self.assertEqual(counts[sampler.combo_key(
+		    'publicationDate:[* TO 1959] AND corpusName:bmj', crit_fields)], 1)
+	
+	def test_8_unlisted_docs(self):
+		"Check a superset with a truncated or outdated value list isn't summed"
+		super_fields = ['publicationDate', 'corpusName']
+		super_info = {
+			'f': {
+				'publicationDate:[* TO 1959] AND corpusName:oup': 4,
+				'publicationDate:[* TO 1959] AND corpusName:bmj': 6,
+				},
+			'nd': 10,
+			'totd': 100
+			}
+		# exhaustive list: nothing missing
+		with patch.object(sampler.api, 'terms_facet',
+		                  return_value=({'oup': 40, 'bmj': 60}, 0)):
+			self.assertEqual(sampler.unlisted_docs(super_info, super_fields,
+			                                       'corpusName'), 0)
+		# truncated facet + a value not cached with the superset
+		with patch.object(sampler.api, 'terms_facet',
+		                  return_value=({'oup': 40, 'bmj': 60, 'rsc': 7}, 3)):
+			self.assertEqual(sampler.unlisted_docs(super_info, super_fields,
+			                                       'corpusName'), 10)
+		# truncated facet without "other" count: unknown
+		buckets = {'c%i' % i: 1 for i in range(sampler.FACET_TRUNCATION)}
+		with patch.object(sampler.api, 'terms_facet',
+		                  return_value=(buckets, None)):
+			self.assertIsNone(sampler.unlisted_docs(super_info, super_fields,
+			                                        'corpusName'))
+		# date ranges are exhaustive
+		self.assertEqual(sampler.unlisted_docs(super_info, super_fields,
+		                                       'publicationDate'), 0)
+	
+	def test_9_id_store_sidecar(self):
+		"Check IdStore rebuilds a truncated sidecar and has fallbacks"
+		ids = ['%040X' % (i * 7919) for i in range(50)]
+		with TemporaryDirectory() as tmp_dir:
+			list_path = path.join(tmp_dir, 'exclu.txt')
+			lfh = open(list_path, 'w')
+			lfh.write("\n".join(ids) + "\n")
+			lfh.close()
+			cache_path = path.join(tmp_dir, 'cache', 'responses.sqlite')
+			with patch.object(sampler.api, 'CACHE_PATH', cache_path):
+				store = sampler.IdStore(list_path)
+				self.assertEqual(store.path, list_path + '.ids.bin')
+				self.assertEqual(len(store), 50)
+				
+				# a partly written sidecar (not a multiple of 20) is rebuilt
+				bfh = open(store.path, 'r+b')
+				bfh.truncate(30)
+				bfh.close()
+				utime(store.path, (9e9, 9e9))
+				store = sampler.IdStore(list_path)
+				self.assertEqual(len(store), 50)
+				self.assertIn(ids[7], store)
+				
+				# sidecar unwritable => user cache dir
+				other_path = path.join(tmp_dir, 'other.txt')
+				lfh = open(other_path, 'w')
+				lfh.write("\n".join(ids[:10]) + "\n")
+				lfh.close()
+				mkdir(other_path + '.ids.bin')
+				store = sampler.IdStore(other_path)
+				self.assertEqual(path.dirname(store.path), path.dirname(cache_path))
+				self.assertIn(ids[3], store)
+			
+			# cache dir unusable too => in memory
+			with patch.object(sampler.api, 'CACHE_PATH',
+			                  path.join(list_path, 'responses.sqlite')):
+				store = sampler.IdStore(other_path)
+				self.assertIsNone(store.path)
+				self.assertEqual(len(store), 10)
+				self.assertIn(ids[3], store)
+				self.assertNotIn(ids[20], store)
+	
+	def test_10_enrich_one_request_per_batch(self):
+		"Check enrich_index sends a single search request per batch"
+		ids = ['%040X' % i for i in range(5)]
+		index = {idi: {'_q': 'corpusName:oup'} for idi in ids}
+		urls = []
+		def fake_get(my_url, use_cache=True):
+			urls.append(my_url)
+			return {'total': 2, 'hits': [{'id': ids[0]}, {'id': ids[3]}]}
+		with patch.object(sampler.api, '_get', side_effect=fake_get), \
+		     patch.object(sampler.api, 'count') as fake_count:
+			sampler.enrich_index(index, batch_size=2, workers=1)
+			fake_count.assert_not_called()
+		self.assertEqual(len(urls), 3)
+		self.assertIn('size=2', urls[0])
+		self.assertIn('size=1', urls[2])
+		self.assertTrue(all('co' in index[idi] for idi in ids))
 
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
\ No newline at end of file
@@ -0,0 +1,70 @@
+#! /usr/bin/python3
+
+import unittest
+
+# tools
+from tempfile         import mkdtemp
+from shutil           import rmtree
+from os               import path
+
+# the tested module
+import xslt
+
+PUB2TEI = path.join(path.dirname(path.realpath(xslt.__file__)),
+                    'etc', 'Pub2TEI', 'Stylesheets', 'Publishers.xsl')
+
+NLM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<article article-type="research-article"><front><journal-meta><journal-title>J Test</journal-title></journal-meta><article-meta><title-group><article-title>Un titre</article-title></title-group></article-meta></front><body><p>text</p></body></article>
+"""
+
+class TestXslt(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = mkdtemp()
+		self.pairs = []
+		for name, contents in (('nlm', NLM_XML), ('broken', '<article>')):
+			src_path = path.join(self.tmp_dir, name + '.xml')
+			with open(src_path, 'w') as fh:
+				fh.write(contents)
+			self.pairs.append((src_path, path.join(self.tmp_dir, name + '.tei.xml')))
+	
+	def tearDown(self):
+		xslt.close_backends()
+		rmtree(self.tmp_dir)
+	
+	@unittest.skipIf(xslt.PySaxonProcessor is None, "saxonche not installed")
+	def test_1_saxonche_pub2tei(self):
+		"Checks Pub2TEI with saxonche and the reuse of the compiled backend"
+		xsl = xslt.get_backend(PUB2TEI, {'teiBiblType': 'biblStruct'})
+		self.assertIsInstance(xsl, xslt.SaxonCBackend)
+		results = xsl.transform(self.pairs)
+		self.assertEqual(results, {self.pairs[0][0]: True,
+		                           self.pairs[1][0]: False})
+		with open(self.pairs[0][1]) as fh:
+			tei = fh.read()
+		self.assertIn('<biblStruct', tei)
+		self.assertIn('Un titre', tei)
+		# same stylesheet and params => same compiled backend
+		self.assertIs(xslt.get_backend(PUB2TEI, {'teiBiblType': 'biblStruct'}), xsl)
+	
+	@unittest.skipIf(xslt.PySaxonProcessor is None, "saxonche not installed")
+	def test_2_sharded(self):
+		"Checks the shards results and that few docs make few shards"
+		params = {'teiBiblType': 'biblStruct'}
+		# 2 docs => 1 shard converted in this process (no pool)
+		results = xslt.transform_sharded(PUB2TEI, params, self.pairs, n_shards=8)
+		self.assertEqual(results, {self.pairs[0][0]: True,
+		                           self.pairs[1][0]: False})
+		self.assertIsNone(xslt.SHARD_POOL)
+		# 2 shards => pool of 2 processes, kept for the next call
+		pairs = self.pairs * xslt.MIN_SHARD_SIZE
+		results = xslt.transform_sharded(PUB2TEI, params, pairs, n_shards=8)
+		self.assertEqual(results, {self.pairs[0][0]: True,
+		                           self.pairs[1][0]: False})
+		self.assertEqual(xslt.SHARD_POOL_SIZE, 2)
+		pool = xslt.SHARD_POOL
+		xslt.transform_sharded(PUB2TEI, params, pairs, n_shards=2)
+		self.assertIs(xslt.SHARD_POOL, pool)
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
@@ -0,0 +1,269 @@
+#! /usr/bin/python3
+"""
+XSLT 2.0 transformation backends (for Pub2TEI conversions)
+
+    xsl = get_backend('Publishers.xsl', {'teiBiblType': 'biblStruct'})
+    results = xsl.transform([(src_path, tgt_path), ...])
+    # => {src_path: True if tgt_path was written}
+
+ - SaxonCBackend: in-process saxonche (Saxon-HE) with the stylesheet
+                  compiled once for all the transform() calls
+ - SaxonBBackend: saxonb-xslt command, 1 call (1 JVM) per transform()
+                  over a temporary dir with links to all its docs
+
+get_backend() keeps each backend for the next calls with the same
+stylesheet and params (=> compiled once per process, even for many
+small conversions), close_backends() frees them.
+
+For big batches, transform_sharded() splits the docs into shards
+converted in parallel (threads for saxonb-xslt, and for saxonche a pool
+of processes kept for the next calls, each with its compiled backend).
+"""
+__author__    = "Romain Loth"
+__copyright__ = "Copyright 2014-5 INIST-CNRS (ISTEX project)"
+__license__   = "LGPL"
+__version__   = "0.1"
+__email__     = "romain.loth@inist.fr"
+__status__    = "Dev"
+
+from os              import path, symlink, mkdir
+from threading       import Lock
+from shutil          import rmtree, move
+from subprocess      import call
+from tempfile        import mkdtemp
+from itertools       import repeat
+from math            import ceil
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sys             import stderr
+
+# optionnel: saxon en librairie python (pip install saxonche)
+try:
+	from saxonche import PySaxonProcessor
+except ImportError:
+	PySaxonProcessor = None
+
+# saxonb-xslt command (package libsaxonb-java)
+SAXONB_CMD = "saxonb-xslt"
+
+# backends kept by get_backend: (xsl_path, mtime, params) => backend
+BACKENDS = {}
+BACKENDS_LOCK = Lock()
+
+# minimum docs per shard in transform_sharded
+# (=> a few docs don't start as many JVMs or processes as cores)
+MIN_SHARD_SIZE = 50
+
+# processes for the saxonche shards, kept between transform_sharded calls
+SHARD_POOL = None
+SHARD_POOL_SIZE = 0
+
+
+class SaxonCBackend(object):
+	"""
+	In-process transformations with saxonche
+	(no JVM startup, stylesheet compiled only once)
+	"""
+	def __init__(self, xsl_path, params=None):
+		if PySaxonProcessor is None:
+			raise ImportError("saxonche is not installed")
+		self.proc = PySaxonProcessor(license=False)
+		xslt_proc = self.proc.new_xslt30_processor()
+		self.executable = xslt_proc.compile_stylesheet(stylesheet_file=xsl_path)
+		if params:
+			for k, v in params.items():
+				self.executable.set_parameter(k, self.proc.make_string_value(v))
+	
+	def transform(self, pairs):
+		"""
+		pairs: [(src_path, tgt_path)...] => {src_path: success}
+		"""
+		results = {}
+		for src_path, tgt_path in pairs:
+			try:
+				self.executable.transform_to_file(
+				                  source_file=path.abspath(src_path),
+				                  output_file=path.abspath(tgt_path))
+				results[src_path] = path.exists(tgt_path)
+			except Exception as xsl_e:
+				print("XSL: (saxonche) %s: %s" % (src_path, xsl_e), file=stderr)
+				results[src_path] = False
+		return results
+	
+	def close(self):
+		self.executable = None
+		self.proc = None
+
+
+class SaxonBBackend(object):
+	"""
+	saxonb-xslt command called once for each batch of docs
+	
+	The docs of a batch are linked into a temporary dir so that they go
+	through a single JVM (-s:dir), then each output is moved to its
+	target path (missing output => failed doc).
+	"""
+	def __init__(self, xsl_path, params=None, debug_lvl=0):
+		self.xsl_path = xsl_path
+		self.params = params or {}
+		self.debug_lvl = debug_lvl
+	
+	def transform(self, pairs):
+		"""
+		pairs: [(src_path, tgt_path)...] => {src_path: success}
+		
+		Raises FileNotFoundError if saxonb-xslt is not installed.
+		"""
+		results = {}
+		tmp_dir = mkdtemp(prefix='xsl-')
+		try:
+			in_dir = path.join(tmp_dir, 'in')
+			out_dir = path.join(tmp_dir, 'out')
+			mkdir(in_dir)
+			mkdir(out_dir)
+			
+			# numbered links => no name collisions between sources
+			linked = []
+			for i, (src_path, tgt_path) in enumerate(pairs):
+				if not path.exists(src_path):
+					results[src_path] = False
+					continue
+				link_name = '%07i.xml' % i
+				symlink(path.abspath(src_path), path.join(in_dir, link_name))
+				linked.append((link_name, src_path, tgt_path))
+			
+			if linked:
+				call_args = [SAXONB_CMD,
+				             "-xsl:%s" % self.xsl_path,
+				             "-s:%s" % in_dir,
+				             "-o:%s" % out_dir]
+				call_args += ["%s=%s" % (k, v) for k, v in self.params.items()]
+				
+				if self.debug_lvl > 0:
+					print("XSL: (debug) appel=%s" % call_args)
+				
+				# subprocess.call -----
+				# (renvoie 2 s'il y a eu ne serait-ce qu'une erreur)
+				call(call_args)
+			
+			for link_name, src_path, tgt_path in linked:
+				try:
+					move(path.join(out_dir, link_name), tgt_path)
+					results[src_path] = True
+				except FileNotFoundError:
+					results[src_path] = False
+		finally:
+			rmtree(tmp_dir)
+		
+		return results
+	
+	def close(self):
+		pass
+
+
+def get_backend(xsl_path, params=None, debug_lvl=0):
+	"""
+	The best available backend: saxonche if installed, else saxonb-xslt
+	
+	The same backend is returned for the same stylesheet and params
+	as long as the stylesheet file doesn't change (no recompilation).
+	"""
+	key = (path.abspath(xsl_path), path.getmtime(xsl_path),
+	       tuple(sorted((params or {}).items())))
+	
+	with BACKENDS_LOCK:
+		if key not in BACKENDS:
+			if PySaxonProcessor is not None:
+				if debug_lvl > 0:
+					print("XSL: backend saxonche")
+				BACKENDS[key] = SaxonCBackend(xsl_path, params)
+			else:
+				if debug_lvl > 0:
+					print("XSL: backend %s" % SAXONB_CMD)
+				BACKENDS[key] = SaxonBBackend(xsl_path, params,
+				                              debug_lvl=debug_lvl)
+		return BACKENDS[key]
+
+
+def close_backends():
+	"""
+	Frees all the backends kept by get_backend (and the shard processes)
+	"""
+	global SHARD_POOL
+	with BACKENDS_LOCK:
+		for backend in BACKENDS.values():
+			backend.close()
+		BACKENDS.clear()
+	
+	# (and those of the shard processes)
+	if SHARD_POOL is not None:
+		SHARD_POOL.shutdown()
+		SHARD_POOL = None
+
+
+def transform_shard(xsl_path, params, pairs, debug_lvl=0):
+	"""
+	One shard with the backend of its process (worker of transform_sharded)
+	"""
+	return get_backend(xsl_path, params, debug_lvl=debug_lvl).transform(pairs)
+
+
+def shard_pool(n_workers):
+	"""
+	The process pool for the saxonche shards, kept between calls so that
+	its processes keep their compiled backend (enlarged if needed)
+	"""
+	global SHARD_POOL, SHARD_POOL_SIZE
+	if SHARD_POOL is None or SHARD_POOL_SIZE < n_workers:
+		if SHARD_POOL is not None:
+			SHARD_POOL.shutdown()
+		# spawn: no fork of a parent where saxonche may already run
+		SHARD_POOL = ProcessPoolExecutor(max_workers=n_workers,
+		                                 mp_context=get_context('spawn'))
+		SHARD_POOL_SIZE = n_workers
+	return SHARD_POOL
+
+
+def transform_sharded(xsl_path, params, pairs, n_shards, debug_lvl=0):
+	"""
+	Splits pairs [(src_path, tgt_path)...] into at most n_shards
+	converted in parallel => {src_path: success}
+	
+	(at least MIN_SHARD_SIZE docs per shard, and a single shard is
+	 converted right here with the backend of this process)
+	
+	(saxonb-xslt: 1 thread per shard driving its own JVM process,
+	 saxonche: the shards go to the SHARD_POOL processes)
+	"""
+	global SHARD_POOL
+	
+	n_shards = max(1, min(n_shards, ceil(len(pairs) / MIN_SHARD_SIZE)))
+	
+	# interleaved shards => similar sizes even if the docs are sorted
+	shards = [pairs[i::n_shards] for i in range(n_shards)]
+	shards = [shard for shard in shards if shard]
+	if not shards:
+		return {}
+	
+	if len(shards) == 1:
+		return transform_shard(xsl_path, params, shards[0], debug_lvl)
+	
+	results = {}
+	map_args = (repeat(xsl_path), repeat(params), shards, repeat(debug_lvl))
+	
+	if PySaxonProcessor is not None:
+		try:
+			for one_shard in shard_pool(len(shards)).map(transform_shard,
+			                                             *map_args):
+				results.update(one_shard)
+		except BrokenProcessPool:
+			# a crashed process: new pool at the next call
+			SHARD_POOL = None
+			raise
+	else:
+		with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+			for one_shard in executor.map(transform_shard, *map_args):
+				results.update(one_shard)
+	
+	return results